@@ -1,17 +1,122 @@
+import fcntl
 import hashlib
 import logging
 import os
+import struct
+import tempfile
+from contextlib import suppress
 from datetime import datetime
+from functools import wraps
 
-from cachelib import RedisCache
+from cachelib import FileSystemCache, RedisCache, SimpleCache
 from flask import Flask
 from flask_wtf import CSRFProtect
 from werkzeug.security import safe_join
 
+from buzuki import metrics
 from config import config
 
+
+class AtomicFileSystemCache(FileSystemCache):
+    """A filesystem cache whose `add` is atomic across processes.
+
+    The rebuild locks of `buzuki.cache_utils` rely on `add` to let only one
+    worker through, but cachelib checks whether the file exists and then
+    writes it. Here the value is written to a temporary file, which is then
+    hard-linked to the file of the key, so readers never see it
+    half-written. Linking fails if the file exists, and adds of the same key
+    hold a lock on a file next to it, so that only one of them can replace
+    an expired value.
+    """
+
+    def add(self, key, value, timeout=None):
+        filename = self._get_filename(key)
+        fd, tmp = tempfile.mkstemp(
+            suffix=self._fs_transaction_suffix, dir=self._path
+        )
+        # The suffix hides the lock file from the pruning and clearing of
+        # the cache.
+        lock_path = f'{filename}.lock{self._fs_transaction_suffix}'
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('I', self._normalize_timeout(timeout)))
+                self.serializer.dump(value, f)
+            os.chmod(tmp, self._mode)
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    os.link(tmp, filename)
+                    return True
+                except FileExistsError:
+                    if self.has(key):
+                        return False
+                # Replace the expired value
+                with suppress(FileNotFoundError):
+                    os.remove(filename)
+                os.link(tmp, filename)
+                return True
+        finally:
+            os.remove(tmp)
+
+
+def make_cache(cache_type, config):
+    """Create a cache backend of type `cache_type` with no expiration.
+
+    Available types are 'redis', 'simple' (in-process memory), 'filesystem'
+    and 'shm' (a filesystem cache in shared memory).
+    """
+    if cache_type == 'redis':
+        return RedisCache(
+            host=config['CACHE_REDIS_HOST'],
+            port=config['CACHE_REDIS_PORT'],
+            default_timeout=0,
+            key_prefix=config['CACHE_KEY_PREFIX'],
+        )
+    elif cache_type == 'simple':
+        return SimpleCache(
+            threshold=config['CACHE_THRESHOLD'],
+            default_timeout=0,
+        )
+    elif cache_type == 'filesystem':
+        return AtomicFileSystemCache(
+            str(config['CACHE_DIR']),
+            threshold=0,
+            default_timeout=0,
+        )
+    elif cache_type == 'shm':
+        return AtomicFileSystemCache(
+            str(config['CACHE_SHM_DIR']),
+            threshold=0,
+            default_timeout=0,
+        )
+    else:
+        raise ValueError(f"Unknown cache type '{cache_type}'")
+
+
+class Cache:
+    """Proxy to the cache backend selected by the `CACHE_TYPE` setting."""
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        self.backend = make_cache(app.config['CACHE_TYPE'], app.config)
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def wrapper(*args, **kwargs):
+            metrics.count_round_trip()
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
 csrf = CSRFProtect()
-cache = RedisCache(default_timeout=0, key_prefix='buzuki_cache_')
+cache = Cache()
 
 
 class DoesNotExist(Exception):
@@ -22,6 +127,10 @@ class InvalidNote(Exception):
     pass
 
 
+class InvalidSong(Exception):
+    pass
+
+
 # Based on https://gist.github.com/mfenniak/2978805
 # but we don't check the file modtime for performance.
 class FileHashFlask(Flask):
@@ -29,6 +138,14 @@ class FileHashFlask(Flask):
         super().__init__(*args, **kwargs)
         self._hash_cache = {}
 
+    def _hash_file(self, filepath):
+        h = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            h.update(f.read())
+        h = h.hexdigest()
+        self._hash_cache[filepath] = h
+        return h
+
     def inject_url_defaults(self, endpoint, values):
         super().inject_url_defaults(endpoint, values)
         if endpoint == 'static' and 'filename' in values:
@@ -38,12 +155,15 @@ class FileHashFlask(Flask):
                 values['h'] = h
                 return
             if os.path.isfile(filepath):
-                h = hashlib.md5()
-                with open(filepath, 'rb') as f:
-                    h.update(f.read())
-                h = h.hexdigest()
-                self._hash_cache[filepath] = h
-                values['h'] = h
+                values['h'] = self._hash_file(filepath)
+
+    def warm_hash_cache(self):
+        """Hash every static file in advance."""
+        for root, _, filenames in os.walk(self.static_folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                relpath = os.path.relpath(path, self.static_folder)
+                self._hash_file(safe_join(self.static_folder, relpath))
 
 
 def create_app(config_name='development'):
@@ -87,6 +207,8 @@ def create_app(config_name='development'):
         }
 
     csrf.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
 
     from buzuki.views import main
     app.register_blueprint(main)
@@ -97,6 +219,4 @@ def create_app(config_name='development'):
     from buzuki.admin.views import admin
     app.register_blueprint(admin, url_prefix='/admin')
 
-    cache.clear()
-
     return app
@@ -1,9 +1,10 @@
-from flask import (Blueprint, abort, flash, redirect, render_template, request,
-                   session, url_for)
+from flask import (Blueprint, abort, flash, make_response, redirect,
+                   render_template, request, session, url_for)
 
 from buzuki import DoesNotExist
 from buzuki.admin.forms import PasswordForm, SongForm
 from buzuki.decorators import delete_cookie, login_required
+from buzuki.metrics import render as render_metrics
 from buzuki.sessions import Session
 from buzuki.songs import Song
 
@@ -107,6 +108,16 @@ def delete(slug):
     return redirect(url_for('main.index'))
 
 
+@admin.route('/metrics')
+@login_required
+def metrics():
+    """Cache and request metrics in the Prometheus text format."""
+    response = make_response(render_metrics())
+    response.headers['Content-Type'] = \
+        'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
 @admin.route('/login/', methods=['GET', 'POST'])
 def login():
     """Enter admin password to login."""
@@ -1,11 +1,11 @@
 import logging
 import re
 
-import elasticsearch
-import requests
 from flask import Blueprint, abort, jsonify, request
 
-from buzuki import DoesNotExist, InvalidNote, cache_utils, elastic
+from buzuki import DoesNotExist, InvalidNote, cache_utils
+from buzuki import search as search_index
+from buzuki.autocomplete import suggest
 from buzuki.playlists import Playlist
 from buzuki.scales import Scale
 from buzuki.songs import Song
@@ -94,19 +94,18 @@ def playlist_song(slug, song_slug):
 def search(query):
     """A list with at most 15 results that match the query."""
     try:
-        results = elastic.search(query)['hits']['hits']
-    except elasticsearch.ConnectionError:
-        return jsonify({'error': "Couldn't connect to elasticsearch"}), 500
+        results = search_index.search(query)['hits']['hits']
+    except search_index.Unavailable as e:
+        return jsonify({'error': str(e)}), 500
 
     return jsonify(list(result['_source'] for result in results))
 
 
 @api.route('/autocomplete/')
 def autocomplete():
-    """A list with at most 15 results that match the query."""
-    query = request.args['q']
-    url = f'http://localhost:1337/autocomplete/?q={query}'
-    return requests.get(url).content
+    """A list with at most 10 names that match the query."""
+    query = request.args.get('q', '')
+    return jsonify(suggest(query))
 
 
 @api.route('/<path>', strict_slashes=False)
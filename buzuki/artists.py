@@ -1,6 +1,6 @@
-from buzuki import DoesNotExist, cache_utils
+from buzuki import DoesNotExist, cache_utils, ngram
 from buzuki.mixins import Model
-from buzuki.songs import Song
+from buzuki.songs import SongSummary
 
 
 class Artist(Model):
@@ -11,15 +11,17 @@ class Artist(Model):
 
     @classmethod
     def get(cls, slug):
-        try:
-            artist = cache_utils.get_artists()[slug]
-        except KeyError:
+        artist = cache_utils.get_artist(slug)
+        if artist is None:
             raise DoesNotExist(f"Artist '{slug}' does not exist")
-        return cls.frommetadata(artist)
+        return cls.frommetadata(artist, slug)
 
     @classmethod
-    def frommetadata(cls, artist):
-        songs = [Song.frommetadata(song) for song in artist['songs']]
+    def frommetadata(cls, artist, slug):
+        songs = [
+            SongSummary(song['name'], song['slug'], artist['name'], slug)
+            for song in artist['songs']
+        ]
         return cls(
             name=artist['name'],
             songs=songs,
@@ -27,8 +29,12 @@ class Artist(Model):
 
     @classmethod
     def all(cls):
-        artists = cache_utils.get_artists().values()
-        return [cls.frommetadata(artist) for artist in artists]
+        artists = cache_utils.get_artists().items()
+        return [cls.frommetadata(artist, slug) for slug, artist in artists]
+
+    @classmethod
+    def search(cls, query):
+        return iter(ngram.search_artists(query))
 
     @property
     def genitive(self):
@@ -0,0 +1,155 @@
+"""Autocomplete for song, artist and scale names.
+
+Names are indexed by every prefix of their words, both unaccented and in
+greeklish, so that "καλ", "ΚΑΛΗ" and "kali" all suggest "Καλησπέρα". The
+index is a trie flattened into a dict from prefixes to the names under
+them, which are kept ranked, so suggestions need no traversal.
+
+Names that start with the query come first, and then shorter names
+before longer ones.
+
+Each process builds the index from its snapshot of the catalog the first
+time it's used. When the catalog changes, only the songs and artists that
+changed are updated.
+"""
+
+import re
+from bisect import insort
+
+from buzuki import cache_utils
+from buzuki.scales import SCALE_SLUGS
+from buzuki.utils import greeklish, unaccented
+
+# Maximum number of suggestions
+LIMIT = 10
+
+# Words are indexed by their first `MAX_PREFIX` characters, like the edge
+# n-gram filter of the elasticsearch index.
+MAX_PREFIX = 20
+
+# Index of the current catalog
+_current = {'songs': None, 'artists': None, 'trie': None}
+
+
+def _normalize(text):
+    return ' '.join(re.findall(r'\w+', unaccented(text).replace('ς', 'σ')))
+
+
+class PrefixTrie:
+    def __init__(self):
+        # URL -> (name, normalized name, rank, words, prefixes)
+        self.entries = {}
+        self.prefixes = {}  # Prefix -> sorted [(rank, URL)]
+
+    def add(self, name, url):
+        self.remove(url)
+        normalized = _normalize(name)
+        rank = (len(normalized), normalized, url)
+        words = set(normalized.split())
+        words.update(greeklish(word) for word in list(words))
+        words.discard('')
+        prefixes = {
+            word[:i]
+            for word in words
+            for i in range(1, min(len(word), MAX_PREFIX) + 1)
+        }
+        for prefix in prefixes:
+            insort(self.prefixes.setdefault(prefix, []), (rank, url))
+        self.entries[url] = (name, normalized, rank, words, prefixes)
+
+    def remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is None:
+            return
+        _, _, rank, _, prefixes = entry
+        for prefix in prefixes:
+            items = self.prefixes[prefix]
+            items.remove((rank, url))
+            if not items:
+                del self.prefixes[prefix]
+
+    def suggest(self, query, limit=LIMIT):
+        """Return the names that match every word of `query`, ranked."""
+        query = _normalize(query)
+        words = query.split()
+        if not words:
+            return []
+
+        lists = []
+        for word in words:
+            items = self.prefixes.get(word[:MAX_PREFIX])
+            if items is None:
+                return []
+            lists.append(items)
+        lists.sort(key=len)
+        others = [{url for _, url in items} for items in lists[1:]]
+        long_words = [word for word in words if len(word) > MAX_PREFIX]
+
+        first = []
+        rest = []
+        for _, url in lists[0]:
+            if not all(url in urls for urls in others):
+                continue
+            name, normalized, _, entry_words, _ = self.entries[url]
+            if long_words and not all(
+                any(entry_word.startswith(word) for entry_word in entry_words)
+                for word in long_words
+            ):
+                continue
+            if normalized.startswith(query):
+                first.append((name, url))
+                if len(first) == limit:
+                    break
+            elif len(rest) < limit:
+                rest.append((name, url))
+
+        return [
+            {'name': name, 'url': url}
+            for name, url in (first + rest)[:limit]
+        ]
+
+
+def _song_url(slug):
+    return f'/songs/{slug}/'
+
+
+def _artist_url(slug):
+    return f'/artists/{slug}/'
+
+
+def _update(trie, old, new, url):
+    """Update `trie` with the entries that changed from `old` to `new`."""
+    for slug in old.keys() - new.keys():
+        trie.remove(url(slug))
+    for slug, value in new.items():
+        if old.get(slug) != value:
+            trie.add(value['name'], url(slug))
+
+
+def _get_trie():
+    songs, artists = cache_utils.get_catalog()
+    trie = _current['trie']
+    if trie is None:
+        trie = PrefixTrie()
+        for name, slug in SCALE_SLUGS.items():
+            trie.add(name, f'/scales/{slug}/')
+        _update(trie, {}, songs, _song_url)
+        _update(trie, {}, artists, _artist_url)
+    else:
+        if songs is not _current['songs']:
+            _update(trie, _current['songs'], songs, _song_url)
+        if artists is not _current['artists']:
+            _update(trie, _current['artists'], artists, _artist_url)
+    _current['songs'] = songs
+    _current['artists'] = artists
+    _current['trie'] = trie
+    return trie
+
+
+def suggest(query, limit=LIMIT):
+    """Return at most `limit` suggestions for `query`.
+
+    Each suggestion is a dict with the name and the URL of a song, an
+    artist or a scale.
+    """
+    return _get_trie().suggest(query, limit)
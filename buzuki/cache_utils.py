@@ -3,18 +3,37 @@
 The disc is accessed only for song detail view, and only if the song is not
 already in OS cache.
 
-There are two caches, song and artist, both of type Dict[str, Dict].
+There are two caches, song and artist, both of type Dict[str, Dict], which
+are stored in the compact format of `buzuki.codec`. Each
+song and artist is also stored under its own key (i.e.
+`song:<generation>:<slug>`), so that single entries can be fetched without
+transferring the whole catalog. The generation is part of the version of
+the catalog, and changes when the catalog is stored without the previous
+one to compare with, so that keys that couldn't be deleted are ignored.
+
+Every process keeps a decoded snapshot of both, tagged with the version of
+the catalog it was loaded from. The snapshot is reused as long as the
+`version` key in the cache is unchanged, so accessing the catalog costs a
+single small lookup instead of transferring and unpickling all of it.
+
+Rebuilds are guarded by a lock in the cache, so that when it's empty, only
+one worker scans the songs directory while the rest serve their previous
+snapshot, or wait for the rebuild if they don't have one.
 
 See test_cache.py for examples.
 """
 
+import json
 import logging
+import os
+import time
 from pathlib import Path
+from uuid import uuid4
 
 import yaml
 from flask import current_app as app
 
-from buzuki import cache
+from buzuki import cache, codec, metrics
 from buzuki.utils import greeklish, unaccented
 
 
@@ -29,99 +48,600 @@ def _sorted_dict(data: dict, last_name: bool = False) -> dict:
     return dict(sorted(data.items(), key=key_func))
 
 
+# Seconds after which a rebuild lock expires, in case its holder died.
+LOCK_TIMEOUT = 60
+
+# Seconds between checks whether another worker has finished a rebuild.
+WAIT_INTERVAL = 0.05
+
+# Use the much faster libyaml loader if available.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# File next to the songs directory with the metadata of every song.
+MANIFEST = 'manifest.json'
+
+# Bump this whenever the metadata stored in the manifest change.
+MANIFEST_VERSION = 2
+
+# Copy of related.yml in a format that's faster to load.
+RELATED_JSON = 'related.json'
+
+# Process-local snapshot of the catalog, as a (version, songs, artists)
+# tuple. It's replaced as a whole, so that other threads never see the
+# version of one catalog with the songs or artists of another.
+_snapshot = (None, None, None)
+
+
+def _set_snapshot(version, songs, artists):
+    global _snapshot
+    _snapshot = (version, songs, artists)
+
+
+def _acquire(name):
+    """Try to acquire the rebuild lock `name` without blocking."""
+    return cache.add(f'lock:{name}', True, timeout=LOCK_TIMEOUT)
+
+
+def _release(name):
+    cache.delete(f'lock:{name}')
+
+
+def _wait(done):
+    """Wait until `done()` is true or the rebuild lock would have expired."""
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        if done():
+            return True
+        time.sleep(WAIT_INTERVAL)
+    return False
+
+
+def _load_catalog():
+    """Fetch and decode the catalog along with its version.
+
+    The songs and artists are None if the catalog isn't cached.
+    """
+    version, songs, artists = cache.get_many('version', 'songs', 'artists')
+    if songs is None or artists is None:
+        return version, None, None
+    try:
+        return (version, *codec.decode(songs, artists))
+    except codec.InvalidFormat as e:
+        logging.warning(e)
+        return version, None, None
+
+
+def _generation(version):
+    """Return the generation of the per-slug keys of catalog `version`."""
+    return version.partition('.')[0]
+
+
+def _count(counter, family):
+    if family is not None:
+        counter.inc(family)
+
+
+def _get_catalog(family=None):
+    """Return the songs and artists, reloading them only if they changed.
+
+    Args:
+        family: The kind of data ('songs' or 'artists') to record a
+                cache hit or miss for in the metrics.
+    """
+    snapshot_version, snapshot_songs, snapshot_artists = _snapshot
+    version = cache.get('version')
+    if version is not None and version == snapshot_version:
+        _count(metrics.cache_hits, family)
+        return snapshot_songs, snapshot_artists
+
+    version, songs, artists = _load_catalog()
+    if version is not None and songs is not None:
+        _count(metrics.cache_hits, family)
+        _set_snapshot(version, songs, artists)
+        return songs, artists
+
+    _count(metrics.cache_misses, family)
+    if _acquire('catalog'):
+        try:
+            return fill_cache()
+        finally:
+            _release('catalog')
+
+    # Another worker is rebuilding the catalog
+    if snapshot_version is not None:
+        return snapshot_songs, snapshot_artists
+    if not _wait(lambda: cache.get('version') is not None):
+        return fill_cache()
+    return _get_catalog()
+
+
 def clear():
     cache.clear()
+    _set_snapshot(None, None, None)
+
+
+def get_catalog():
+    """Return the songs and artists of the same version of the catalog.
+
+    The same objects are returned until the catalog changes.
+    """
+    return _get_catalog('songs')
 
 
 def get_songs():
-    songs = cache.get('songs')
-    if not songs:
-        songs, _ = fill_cache()
+    songs, _ = _get_catalog('songs')
     return songs
 
 
 def get_artists():
-    artists = cache.get('artists')
-    if not artists:
-        _, artists = fill_cache()
+    _, artists = _get_catalog('artists')
     return artists
 
 
+def count_songs():
+    """Return the number of songs in the catalog."""
+    snapshot_version, snapshot_songs, _ = _snapshot
+    version = cache.get('version')
+    if version is not None and version == snapshot_version:
+        metrics.cache_hits.inc('songs')
+        return len(snapshot_songs)
+
+    num = cache.get('num_songs')
+    if version is None or num is None:
+        return len(get_songs())
+    metrics.cache_hits.inc('songs')
+    return num
+
+
+def _get_entries(kind, slugs):
+    """Return the cached entries of kind `kind` ('songs' or 'artists').
+
+    Slugs that don't exist in the catalog are left out of the result.
+    """
+    slugs = list(dict.fromkeys(slugs))
+    prefix = kind[:-1]
+
+    version = cache.get('version')
+    if version is not None and version != _snapshot[0]:
+        generation = _generation(version)
+        values = cache.get_many(
+            *[f'{prefix}:{generation}:{slug}' for slug in slugs]
+        )
+        entries = {
+            slug: value
+            for slug, value in zip(slugs, values)
+            if value is not None
+        }
+        if len(entries) == len(slugs):
+            metrics.cache_hits.inc(kind)
+            return entries
+
+    # The snapshot is current, or some entries are missing, in
+    # which case the whole catalog is checked for them.
+    songs, artists = _get_catalog(kind)
+    catalog = songs if kind == 'songs' else artists
+    return {slug: catalog[slug] for slug in slugs if slug in catalog}
+
+
+def get_song(slug):
+    """Return the cached data of song `slug` or None if it doesn't exist."""
+    return _get_entries('songs', [slug]).get(slug)
+
+
+def get_many_songs(slugs):
+    """Return a dict with the cached data of every song in `slugs`."""
+    return _get_entries('songs', slugs)
+
+
+def get_artist(slug):
+    """Return the cached data of artist `slug` or None if it doesn't exist."""
+    return _get_entries('artists', [slug]).get(slug)
+
+
+def _related_mtime():
+    """Return the mtime of related.yml, or 0 if it doesn't exist."""
+    path: Path = app.config['DIR'] / 'related.yml'
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
 def get_related(slug):
-    related = cache.get('related')
-    if not related:
-        fill_related_cache()
+    """Return the related songs of `slug`.
+
+    The cache is filled again when related.yml changes, i.e. after
+    `manage.py related`.
+    """
+    mtime = _related_mtime()
+    if cache.get('related') == mtime:
+        metrics.cache_hits.inc('related')
+    else:
+        metrics.cache_misses.inc('related')
+        if _acquire('related'):
+            try:
+                fill_related_cache()
+            finally:
+                _release('related')
+        elif not _wait(lambda: cache.get('related') == mtime):
+            fill_related_cache()
     return cache.get(f'related:{slug}')
 
 
+def _store(
+    songs, artists, old_version=None, old_songs=None, old_artists=None
+):
+    """Store the catalog in the cache and make it the current snapshot.
+
+    Only the per-slug entries that differ from `old_songs` and `old_artists`
+    of catalog `old_version` are written, and the ones that no longer exist
+    are deleted. Without an old catalog, the keys of deleted entries are
+    unknown, so every entry is written in a new generation of keys.
+    """
+    entries = {}
+    removed = []
+    if old_version is None or old_songs is None or old_artists is None:
+        generation = uuid4().hex
+        old_songs = old_artists = {}
+        # Delete the keys that this process knows of, which are all of
+        # them unless the catalog changed since its snapshot.
+        snapshot_version, snapshot_songs, snapshot_artists = _snapshot
+        if snapshot_version is not None:
+            old_generation = _generation(snapshot_version)
+            for prefix, old in [
+                ('song', snapshot_songs),
+                ('artist', snapshot_artists),
+            ]:
+                removed.extend(
+                    f'{prefix}:{old_generation}:{slug}' for slug in old
+                )
+    else:
+        generation = _generation(old_version)
+
+    for prefix, new, old in [
+        ('song', songs, old_songs),
+        ('artist', artists, old_artists),
+    ]:
+        for slug, value in new.items():
+            if old.get(slug) != value:
+                entries[f'{prefix}:{generation}:{slug}'] = value
+        removed.extend(
+            f'{prefix}:{generation}:{slug}' for slug in old if slug not in new
+        )
+
+    if entries:
+        cache.set_many(entries)
+    if removed:
+        cache.delete_many(*removed)
+
+    # The version is set last, so that anyone who sees
+    # it is guaranteed to also see the data it refers to.
+    version = f'{generation}.{uuid4().hex}'
+    songs_value, artists_value = codec.encode(songs, artists)
+    cache.set_many({
+        'songs': songs_value,
+        'artists': artists_value,
+        'num_songs': len(songs),
+    })
+    cache.set('version', version)
+    _set_snapshot(version, songs, artists)
+
+
+def _add_to_artist(artists, artist_slug, artist, name, slug):
+    if artist_slug not in artists:
+        artists[artist_slug] = {
+            'name': artist,
+            'songs': [],
+        }
+    artists[artist_slug]['songs'].append({
+        'name': name,
+        'slug': slug,
+    })
+
+
+def _sort_artist_songs(artist):
+    artist['songs'].sort(key=lambda song: unaccented(song['name']))
+
+
+def _read_header(path: Path) -> dict:
+    """Parse the metadata of a song from the first lines of its file."""
+    with path.open() as f:
+        name = f.readline().strip().split(' (')[0]
+        artist = f.readline().strip()
+        f.readline()  # Link
+        f.readline()  # Empty line
+        scale_lines = []
+        line = f.readline()
+        while line not in {'\n', ''}:
+            scale_lines.append(line)
+            line = f.readline()
+        scale = ''.join(scale_lines).strip()
+
+    return {
+        'filename': path.name,
+        'name': name,
+        'slug': greeklish(name),
+        'artist': artist,
+        'artist_slug': greeklish(artist),
+        'scale': scale,
+        'sort_key': unaccented(name),
+        'artist_sort_key': unaccented(artist.split()[-1]),
+    }
+
+
+def _read_manifest(path: Path) -> dict:
+    try:
+        manifest = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def _write_json(path: Path, data):
+    """Atomically replace `path` with `data` encoded as compact JSON."""
+    text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    try:
+        tmp.write_text(text)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"Couldn't write {path}: {e}")
+
+
+def scan_songs() -> list:
+    """Return the metadata of every song file.
+
+    The metadata are kept in a manifest next to the songs directory, along
+    with the modification time and size of each file, so only files that
+    changed since the last scan are opened.
+    """
+    directory: Path = app.config['DIR'] / 'songs'
+    manifest_path: Path = app.config['DIR'] / MANIFEST
+    manifest = _read_manifest(manifest_path)
+
+    files = {}
+    changed = False
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Skip the temporary files of songs being written
+            if entry.name.startswith('.'):
+                continue
+            stat = entry.stat()
+            metadata = manifest.get(entry.name)
+            if (
+                metadata is None
+                or metadata['mtime'] != stat.st_mtime_ns
+                or metadata['size'] != stat.st_size
+            ):
+                metadata = _read_header(Path(entry.path))
+                metadata['mtime'] = stat.st_mtime_ns
+                metadata['size'] = stat.st_size
+                changed = True
+            files[entry.name] = metadata
+
+    if changed or len(files) != len(manifest):
+        _write_json(
+            manifest_path, {'version': MANIFEST_VERSION, 'files': files}
+        )
+
+    return list(files.values())
+
+
+@metrics.fill('catalog')
 def fill_cache():
     logging.info("Filling song/artist cache...")
 
+    metadata = scan_songs()
+
+    # Sort songs by song name
+    metadata.sort(key=lambda song: song['sort_key'])
+
     songs = {}
     artists = {}
+    for song in metadata:
+        songs[song['slug']] = {
+            'name': song['name'],
+            'artist': song['artist'],
+            'artist_slug': song['artist_slug'],
+            'scale': song['scale'],
+        }
+
+    # Sort artists by artist last name. Since the songs are already sorted,
+    # so are the songs of each artist.
+    metadata.sort(key=lambda song: song['artist_sort_key'])
+    for song in metadata:
+        if songs[song['slug']]['artist_slug'] == song['artist_slug']:
+            _add_to_artist(
+                artists,
+                song['artist_slug'],
+                song['artist'],
+                song['name'],
+                song['slug'],
+            )
+
+    _store(songs, artists, *_load_catalog())
 
-    directory: Path = app.config['DIR'] / 'songs'
-    path: Path
-    for path in directory.iterdir():
-        with path.open() as f:
-            name = f.readline().strip().split(' (')[0]
-            slug = greeklish(name)
-            artist = f.readline().strip()
-            artist_slug = greeklish(artist)
-            f.readline()  # Link
-            f.readline()  # Empty line
-            scale_lines = []
-            line = f.readline()
-            while line != '\n':
-                scale_lines.append(line)
-                line = f.readline()
-            scale = ''.join(scale_lines).strip()
-
-            songs[slug] = {
-                'name': name,
-                'artist': artist,
-                'artist_slug': artist_slug,
-                'scale': scale,
-            }
-
-            if artist_slug not in artists:
-                artists[artist_slug] = {
-                    'name': artist,
-                    'songs': [],
-                }
-            artists[artist_slug]['songs'].append({
-                'name': name,
-                'slug': greeklish(name),
-            })
+    logging.info("Filled song/artist cache")
 
-    # Sort songs by song name
-    songs = _sorted_dict(songs)
+    return songs, artists
 
-    # Sort artists by artist last name
-    artists = _sorted_dict(artists, last_name=True)
 
-    # Sort songs of each artist
-    for value in artists.values():
-        value['songs'].sort(key=lambda song: unaccented(song['name']))
+def refill():
+    """Fill the cache from disk, holding the rebuild lock of the catalog.
 
-    cache.set('songs', songs)
-    cache.set('artists', artists)
+    Use this instead of `fill_cache` after writing songs, so that patches
+    of other workers aren't overwritten by a fill that started earlier.
+    """
+    if not _wait(lambda: _acquire('catalog')):
+        # The holder of the lock died
+        return fill_cache()
+    try:
+        return fill_cache()
+    finally:
+        _release('catalog')
 
-    logging.info("Filled song/artist cache")
 
-    return songs, artists
+def _patch(slug, metadata=None):
+    """Replace the cached entry of `slug` with `metadata`, or remove it.
 
+    `metadata` is read from the song file by `_read_header`, like when the
+    cache is filled, so that both give the same entries.
 
-def fill_related_cache():
-    logging.info("Filling related cache...")
+    The catalog is copied instead of being modified in place, because the
+    current snapshot may still be in use. If the catalog isn't cached yet,
+    there is nothing to do, as it will be filled from disk when needed.
 
+    Patches hold the rebuild lock of the catalog, so that concurrent ones
+    don't drop each other's changes. If it can't be acquired, the cached
+    catalog is invalidated instead.
+    """
+    if cache.get('version') is None:
+        return
+
+    if not _wait(lambda: _acquire('catalog')):
+        cache.delete('version')
+        return
+    try:
+        _patch_locked(slug, metadata)
+    finally:
+        _release('catalog')
+
+
+def _patch_locked(slug, metadata):
+    version = cache.get('version')
+    if version is None:
+        return
+    snapshot_version, snapshot_songs, snapshot_artists = _snapshot
+    if version == snapshot_version:
+        old_songs, old_artists = snapshot_songs, snapshot_artists
+    else:
+        version, old_songs, old_artists = _load_catalog()
+        if version is None or old_songs is None:
+            # Fill it from disk on the next read
+            cache.delete('version')
+            return
+
+    songs = dict(old_songs)
+    artists = dict(old_artists)
+
+    # The slug in the header may differ from the filename, i.e. if the
+    # name contains " (".
+    slugs = {slug}
+    if metadata is not None:
+        slugs.add(metadata['slug'])
+    for old_slug in slugs:
+        old = songs.pop(old_slug, None)
+        if old is None:
+            continue
+        artist_slug = old['artist_slug']
+        artist = artists[artist_slug]
+        remaining = [s for s in artist['songs'] if s['slug'] != old_slug]
+        if remaining:
+            artists[artist_slug] = {**artist, 'songs': remaining}
+        else:
+            del artists[artist_slug]
+
+    if metadata is not None:
+        slug = metadata['slug']
+        artist_slug = metadata['artist_slug']
+        songs[slug] = {
+            'name': metadata['name'],
+            'artist': metadata['artist'],
+            'artist_slug': artist_slug,
+            'scale': metadata['scale'],
+        }
+        songs = _sorted_dict(songs)
+
+        is_new_artist = artist_slug not in artists
+        if not is_new_artist:
+            artist = artists[artist_slug]
+            artists[artist_slug] = {**artist, 'songs': list(artist['songs'])}
+        _add_to_artist(
+            artists, artist_slug, metadata['artist'], metadata['name'], slug
+        )
+        _sort_artist_songs(artists[artist_slug])
+        if is_new_artist:
+            artists = _sorted_dict(artists, last_name=True)
+
+    _store(songs, artists, version, old_songs, old_artists)
+
+
+def update_song(song):
+    """Add `song` to the cache or replace it, keeping the sort order.
+
+    The song must have been written to its file.
+    """
+    _patch(song.slug, _read_header(song.directory / song.slug))
+
+
+def remove_song(slug):
+    """Remove the song `slug` from the cache."""
+    _patch(slug)
+
+
+def warm():
+    """Fill the catalog, related and static file hash caches.
+
+    Run in the gunicorn master before forking, so that the workers start
+    with hot caches, or with `manage.py warm`.
+    """
+    refill()
+    fill_related_cache()
+    app.warm_hash_cache()
+
+
+def _load_related() -> dict:
+    """Load related.yml through a JSON copy of it, which is much faster.
+
+    The copy records the mtime and size of the related.yml it was made
+    from, and it's used only if they are unchanged, even if related.yml
+    was replaced by an older file.
+    """
     path: Path = app.config['DIR'] / 'related.yml'
+    json_path: Path = app.config['DIR'] / RELATED_JSON
     try:
-        all_related = yaml.safe_load(path.read_text())
+        stat = path.stat()
     except FileNotFoundError:
-        all_related = {}
-    for slug, related in all_related.items():
-        cache.set(f'related:{slug}', related)
-    cache.set('related', True)
+        return {}
+    source = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    try:
+        data = json.loads(json_path.read_text())
+        if data.get('source') == source:
+            return data['related']
+    except (FileNotFoundError, ValueError, AttributeError, KeyError):
+        pass
+
+    all_related = yaml.load(path.read_text(), Loader=YamlLoader) or {}
+    _write_json(json_path, {'source': source, 'related': all_related})
+    return all_related
+
+
+@metrics.fill('related')
+def fill_related_cache():
+    logging.info("Filling related cache...")
+
+    # The mtime is taken first, so that if related.yml is written while
+    # it's loaded, the cache is filled again.
+    mtime = _related_mtime()
+    all_related = _load_related()
+    # Write all entries at once, i.e. in a single
+    # round-trip with redis, before marking them as filled.
+    if all_related:
+        cache.set_many({
+            f'related:{slug}': related
+            for slug, related in all_related.items()
+        })
+    removed = [
+        f'related:{slug}'
+        for slug in cache.get('related_slugs') or []
+        if slug not in all_related
+    ]
+    if removed:
+        cache.delete_many(*removed)
+    cache.set('related_slugs', list(all_related))
+    cache.set('related', mtime)
 
     logging.info("Filled related cache")
@@ -0,0 +1,101 @@
+"""Compact encoding of the cached catalog.
+
+The songs and artists dicts are stored in columns instead of as dicts of
+dicts. Strings that repeat, like artists and scales, are stored once in a
+string table and referenced by index, and the songs of each artist are
+stored as indices into the songs. This makes the cached values a lot
+smaller and faster to decode than pickling the dicts themselves.
+
+Both values are tagged with `FORMAT`, so that values written by an older
+version of the format are rejected instead of being misread.
+"""
+
+from itertools import islice
+
+# Bump the version whenever the layout below changes.
+FORMAT = ('buzuki-catalog', 1)
+
+
+class InvalidFormat(ValueError):
+    pass
+
+
+def encode(songs: dict, artists: dict) -> tuple:
+    """Encode the songs and artists dicts into two compact values."""
+    strings = []
+    indices = {}
+
+    def intern(string):
+        index = indices.get(string)
+        if index is None:
+            index = indices[string] = len(strings)
+            strings.append(string)
+        return index
+
+    slugs = list(songs)
+    names = []
+    columns = []
+    for song in songs.values():
+        names.append(song['name'])
+        columns.append(intern(song['artist']))
+        columns.append(intern(song['artist_slug']))
+        columns.append(intern(song['scale']))
+
+    positions = {slug: i for i, slug in enumerate(slugs)}
+    artist_slugs = []
+    artist_names = []
+    counts = []
+    artist_songs = []
+    for slug, artist in artists.items():
+        artist_slugs.append(intern(slug))
+        artist_names.append(intern(artist['name']))
+        counts.append(len(artist['songs']))
+        artist_songs.extend(
+            positions[song['slug']] for song in artist['songs']
+        )
+
+    songs_value = (FORMAT, strings, slugs, names, columns)
+    artists_value = (FORMAT, artist_slugs, artist_names, counts, artist_songs)
+    return songs_value, artists_value
+
+
+def decode(songs_value, artists_value) -> tuple:
+    """Decode the values created by `encode` back into dicts.
+
+    Raises `InvalidFormat` if the values were encoded in another format.
+    """
+    try:
+        songs_format, strings, slugs, names, columns = songs_value
+        artists_format, artist_slugs, artist_names, counts, artist_songs = \
+            artists_value
+    except (TypeError, ValueError):
+        raise InvalidFormat("Cached catalog has an unknown format")
+    if songs_format != FORMAT or artists_format != FORMAT:
+        raise InvalidFormat(
+            f"Cached catalog has format {songs_format}, not {FORMAT}"
+        )
+
+    it = iter(columns)
+    songs = {
+        slug: {
+            'name': name,
+            'artist': strings[artist],
+            'artist_slug': strings[artist_slug],
+            'scale': strings[scale],
+        }
+        for slug, name, artist, artist_slug, scale
+        in zip(slugs, names, it, it, it)
+    }
+
+    artists = {}
+    it = iter(artist_songs)
+    for slug, name, count in zip(artist_slugs, artist_names, counts):
+        artists[strings[slug]] = {
+            'name': strings[name],
+            'songs': [
+                {'name': names[i], 'slug': slugs[i]}
+                for i in islice(it, count)
+            ],
+        }
+
+    return songs, artists
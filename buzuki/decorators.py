@@ -4,8 +4,8 @@ from functools import wraps
 
 from flask import flash, make_response, redirect, request, session, url_for
 
+from buzuki import cache_utils
 from buzuki.playlists import get_selected_playlist
-from buzuki.songs import Song
 
 
 def login_required(f):
@@ -26,7 +26,7 @@ def add_slug_to_cookie(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         playlist = get_selected_playlist()
-        num_songs = playlist.num if playlist else len(Song.all())
+        num_songs = playlist.num if playlist else cache_utils.count_songs()
         limit = int(0.9 * num_songs)
 
         response = make_response(f(*args, **kwargs))
@@ -1,7 +1,14 @@
+from datetime import datetime
+
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk
 
 es = Elasticsearch()
 
+# Searches and updates go through this alias, which points to the latest
+# complete index.
+ALIAS = 'documents'
+
 # Tokenizers
 slug_tokenizer = {
     'type': 'pattern',
@@ -86,11 +93,10 @@ keyword_field = {
 }
 
 
-def create_index():
-    """Delete and create the `documents` index again."""
-    es.indices.delete(index='*')
-    body = {
+def _index_body(**settings):
+    return {
         'settings': {
+            **settings,
             'analysis': {
                 'tokenizer': {
                     'slug_tokenizer': slug_tokenizer,
@@ -108,7 +114,7 @@ def create_index():
                     'greek_stemmed': greek_stemmed_analyzer,
                     'slug': slug_analyzer,
                 },
-            }
+            },
         },
         'mappings': {
             'properties': {
@@ -119,10 +125,78 @@ def create_index():
             }
         },
     }
-    es.indices.create(index='documents', body=body)
 
 
-def index(item):
+def _swap_alias(name):
+    """Point the `documents` alias to the `name` index atomically.
+
+    The indices the alias pointed to before are deleted.
+    """
+    actions = [{'add': {'index': name, 'alias': ALIAS}}]
+    old = []
+    if es.indices.exists_alias(name=ALIAS):
+        old = list(es.indices.get_alias(name=ALIAS))
+        actions.extend(
+            {'remove': {'index': index, 'alias': ALIAS}} for index in old
+        )
+    elif es.indices.exists(index=ALIAS):
+        # An index created before `documents` became an alias
+        actions.append({'remove_index': {'index': ALIAS}})
+    es.indices.update_aliases(body={'actions': actions})
+    for index in old:
+        es.indices.delete(index=index)
+
+
+def create_index():
+    """Replace the `documents` index with an empty one."""
+    rebuild_index([])
+
+
+def rebuild_index(items, chunk_size=500, thread_count=1):
+    """Build a new index with `items` and swap it in when it's complete.
+
+    The documents are streamed from `items` in bulk requests of
+    `chunk_size` documents, and `thread_count` requests are sent in
+    parallel. Until the new index is complete, searches are served by the
+    old one.
+    """
+    name = f'{ALIAS}-{datetime.now():%Y%m%d%H%M%S%f}'
+    # Refreshing and replicating while the index is built only slows it
+    # down.
+    es.indices.create(
+        index=name,
+        body=_index_body(refresh_interval='-1', number_of_replicas=0),
+    )
+    try:
+        actions = (
+            {
+                '_index': name,
+                '_id': item.document_id,
+                '_source': _document(item),
+            }
+            for item in items
+        )
+        if thread_count > 1:
+            results = parallel_bulk(
+                es, actions, thread_count=thread_count, chunk_size=chunk_size
+            )
+        else:
+            results = streaming_bulk(es, actions, chunk_size=chunk_size)
+        for _ in results:
+            pass
+
+        es.indices.put_settings(
+            index=name,
+            body={'refresh_interval': None, 'number_of_replicas': None},
+        )
+        es.indices.refresh(index=name)
+        _swap_alias(name)
+    except BaseException:
+        es.indices.delete(index=name, ignore_unavailable=True)
+        raise
+
+
+def _document(item):
     body = {
         'name': item.name,
         'slug': item.slug,
@@ -132,11 +206,41 @@ def index(item):
     if hasattr(item, 'body'):
         body['body'] = item.body
 
-    es.index(index='documents', document=body, id=item.slug)
+    return body
+
+
+def index(item):
+    es.index(index=ALIAS, document=_document(item), id=item.document_id)
+
+
+def index_many(items):
+    """Index many items with one bulk request."""
+    actions = (
+        {
+            '_index': ALIAS,
+            '_id': item.document_id,
+            '_source': _document(item),
+        }
+        for item in items
+    )
+    bulk(es, actions)
+
+
+def delete_many(ids):
+    """Delete many documents with one bulk request.
+
+    Documents are identified by their kind and slug, e.g. 'songs/<slug>'.
+    Documents that don't exist are ignored.
+    """
+    actions = (
+        {'_op_type': 'delete', '_index': ALIAS, '_id': document_id}
+        for document_id in ids
+    )
+    bulk(es, actions, ignore_status=(404,))
 
 
-def delete(slug):
-    es.delete(index='documents', id=slug)
+def delete(document_id):
+    es.delete(index=ALIAS, id=document_id)
 
 
 def search(query, extra=[]):
@@ -159,4 +263,4 @@ def search(query, extra=[]):
         },
         '_source': ['name', 'slug', 'url']
     }
-    return es.search(index='documents', body=body)
+    return es.search(index=ALIAS, body=body)
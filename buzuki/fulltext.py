@@ -0,0 +1,206 @@
+"""Embedded full-text search with SQLite FTS5.
+
+This is a replacement for the elasticsearch index of `buzuki.elastic`
+that runs in-process, and its analysis mimics the analyzers there:
+
+- Names and bodies are lowercased, unaccented and final sigmas become
+  sigmas, like with the greek lowercase filter.
+- Every query word matches words that start with it, like the edge n-gram
+  filter used for indexing.
+- Slugs are split on underscores, so that greeklish queries match them.
+- Query words are replaced by their synonyms.
+
+The results have the shape of the elasticsearch ones.
+"""
+
+import os
+import re
+import sqlite3
+from contextlib import closing
+from itertools import islice
+from pathlib import Path
+
+from flask import current_app as app
+
+from buzuki.utils import unaccented
+
+# The synonym filter of `buzuki.elastic`
+SYNONYMS = {
+    'γιαννης': 'γιοβαν τσαους',
+    'ειτζιριδης': 'γιοβαν τσαους',
+    'προυσα': 'ηρωίνη μαυράκι',
+}
+
+# Fields are weighted like the `name^2`, `body` and `slug^2` fields of the
+# elasticsearch query.
+WEIGHTS = (2.0, 1.0, 2.0)
+
+SCHEMA = """
+CREATE TABLE documents (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    name_text TEXT NOT NULL,
+    body_text TEXT NOT NULL,
+    slug_text TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE documents_fts USING fts5(
+    name_text, body_text, slug_text,
+    content='documents', content_rowid='rowid',
+    prefix='1 2 3'
+);
+CREATE TRIGGER documents_insert AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts(rowid, name_text, body_text, slug_text)
+    VALUES (new.rowid, new.name_text, new.body_text, new.slug_text);
+END;
+CREATE TRIGGER documents_delete AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts(
+        documents_fts, rowid, name_text, body_text, slug_text
+    )
+    VALUES ('delete', old.rowid, old.name_text, old.body_text, old.slug_text);
+END;
+"""
+
+
+def _normalize(text: str) -> str:
+    return unaccented(text).replace('ς', 'σ')
+
+
+_SYNONYMS = {
+    _normalize(word): _normalize(synonym).split()
+    for word, synonym in SYNONYMS.items()
+}
+
+
+def _connect():
+    return sqlite3.connect(app.config['SEARCH_DB'])
+
+
+def create_index():
+    """Replace the search index with an empty one."""
+    rebuild_index([])
+
+
+def _row(item):
+    return (
+        item.document_id,
+        item.name,
+        item.url,
+        _normalize(item.name),
+        _normalize(getattr(item, 'body', None) or ''),
+        item.slug.replace('_', ' '),
+    )
+
+
+def index_many(items):
+    """Index many items in one transaction."""
+    with closing(_connect()) as db, db:
+        for row in map(_row, items):
+            db.execute('DELETE FROM documents WHERE id = ?', row[:1])
+            db.execute('INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)', row)
+
+
+def index(item):
+    index_many([item])
+
+
+def rebuild_index(items, chunk_size=500, thread_count=1):
+    """Build a new index with `items` and swap it in when it's complete.
+
+    The index is built in a temporary file next to the database, which
+    then replaces it, so searches are served by the old index until then.
+    Rows are inserted `chunk_size` at a time. SQLite has a single writer,
+    so `thread_count` is ignored.
+    """
+    path = Path(app.config['SEARCH_DB'])
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.unlink(missing_ok=True)
+    try:
+        with closing(sqlite3.connect(tmp)) as db, db:
+            db.execute('PRAGMA journal_mode = OFF')
+            # Replaced rows are removed from the full-text index too
+            db.execute('PRAGMA recursive_triggers = ON')
+            db.executescript(SCHEMA)
+            rows = map(_row, items)
+            while chunk := list(islice(rows, chunk_size)):
+                db.executemany(
+                    'INSERT OR REPLACE INTO documents '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    chunk,
+                )
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def delete_many(ids):
+    """Delete many documents in one transaction.
+
+    Documents are identified by their kind and slug, e.g. 'songs/<slug>'.
+    """
+    with closing(_connect()) as db, db:
+        db.executemany(
+            'DELETE FROM documents WHERE id = ?', [(i,) for i in ids]
+        )
+
+
+def delete(document_id):
+    delete_many([document_id])
+
+
+def _match_expression(query):
+    """Translate a query to an FTS5 query where all words must match."""
+    words = []
+    for word in re.findall(r'\w+', _normalize(query)):
+        words.extend(_SYNONYMS.get(word, [word]))
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+
+def search(query, extra=[]):
+    """Search the index and return the first 15 results.
+
+    Args:
+        query: The search query (all words must match).
+        extra: A list of extra queries. Only "url:<kind>" is supported
+               (i.e. "url:artists" to search only for artists).
+    """
+    hits = []
+    expression = _match_expression(query)
+    if expression:
+        conditions = ['documents_fts MATCH ?']
+        params = [expression]
+        for term in extra:
+            field, _, value = term.partition(':')
+            if field != 'url':
+                raise ValueError(f"Unsupported extra query '{term}'")
+            conditions.append('documents.url LIKE ?')
+            params.append(f'/{value}/%')
+
+        sql = f"""
+            SELECT documents.id, documents.name, documents.url,
+                bm25(documents_fts, {', '.join(map(str, WEIGHTS))}) AS rank
+            FROM documents_fts
+            JOIN documents ON documents.rowid = documents_fts.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY rank
+            LIMIT 15
+        """
+        with closing(_connect()) as db:
+            try:
+                rows = db.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                # The index hasn't been created yet
+                if 'no such table' not in str(e):
+                    raise
+                rows = []
+
+        for document_id, name, url, rank in rows:
+            slug = document_id.partition('/')[2]
+            hits.append({
+                '_id': document_id,
+                '_score': -rank,
+                '_source': {'name': name, 'slug': slug, 'url': url},
+            })
+
+    return {'hits': {'total': {'value': len(hits)}, 'hits': hits}}
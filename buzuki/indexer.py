@@ -0,0 +1,139 @@
+"""Incremental updates of the search index.
+
+Writes of songs enqueue the songs and artists whose documents they affect,
+and a background thread applies them in batches, shortly after the writes
+that caused them. Documents are read when the batch is applied, so a song
+that's written many times is indexed once, and the documents of songs and
+artists that no longer exist are deleted.
+
+Updates that are pending when the process exits are applied before it
+does. If the search backend fails, the batch is logged and dropped, and
+`manage.py index` brings the index up to date again.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from itertools import islice
+
+from flask import current_app as app
+
+from buzuki import DoesNotExist
+from buzuki import search as search_index
+
+# Seconds to wait for more updates before applying a batch
+BATCH_DELAY = 0.5
+
+# Maximum number of documents updated with one request
+BATCH_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+# Pending updates as {(app, kind, slug): None}, which is an ordered set
+_pending = {}
+_lock = threading.Lock()
+# Held while a batch is applied, so that batches are applied in order
+_apply_lock = threading.Lock()
+_wakeup = threading.Event()
+# The worker thread and the process that started it, as a forked process
+# doesn't inherit it.
+_worker = {'thread': None, 'pid': None}
+
+
+def _get(kind, slug):
+    from buzuki.artists import Artist
+    from buzuki.songs import Song
+
+    if kind == 'songs':
+        return Song.get(slug)
+    return Artist.get(slug)
+
+
+def _apply(application, keys):
+    with application.app_context():
+        items = []
+        deleted = []
+        for kind, slug in keys:
+            try:
+                items.append(_get(kind, slug))
+            except DoesNotExist:
+                deleted.append(f'{kind}/{slug}')
+        if items:
+            search_index.index_many(items)
+        if deleted:
+            search_index.delete_many(deleted)
+
+
+def flush():
+    """Apply the pending updates now."""
+    with _apply_lock:
+        while True:
+            with _lock:
+                _wakeup.clear()
+                batch = list(islice(_pending, BATCH_SIZE))
+                for key in batch:
+                    del _pending[key]
+            if not batch:
+                return
+
+            by_app = {}
+            for application, kind, slug in batch:
+                by_app.setdefault(application, []).append((kind, slug))
+            for application, keys in by_app.items():
+                _apply(application, keys)
+
+
+def _flush_or_log():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Couldn't update the search index")
+
+
+def _work():
+    while True:
+        _wakeup.wait()
+        time.sleep(BATCH_DELAY)
+        _flush_or_log()
+
+
+def _start_worker():
+    thread = threading.Thread(target=_work, name='indexer', daemon=True)
+    thread.start()
+    if _worker['thread'] is None:
+        atexit.register(_flush_or_log)
+    _worker['thread'] = thread
+    _worker['pid'] = os.getpid()
+
+
+def enqueue(songs=(), artists=()):
+    """Update the documents of `songs` and `artists` in the background.
+
+    Both are iterables of slugs. Nothing is done unless the
+    `SEARCH_AUTOINDEX` setting is enabled.
+    """
+    if not app.config['SEARCH_AUTOINDEX']:
+        return
+
+    application = app._get_current_object()
+    with _lock:
+        for slug in songs:
+            _pending[(application, 'songs', slug)] = None
+        for slug in artists:
+            _pending[(application, 'artists', slug)] = None
+        if _worker['pid'] != os.getpid():
+            _start_worker()
+    _wakeup.set()
+
+
+def update(songs=(), artists=()):
+    """Update the documents of `songs` and `artists` now.
+
+    Unlike `enqueue`, the documents are updated with one request whether
+    or not the `SEARCH_AUTOINDEX` setting is enabled.
+    """
+    keys = [('songs', slug) for slug in songs]
+    keys += [('artists', slug) for slug in artists]
+    _apply(app._get_current_object(), keys)
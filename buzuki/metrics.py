@@ -0,0 +1,324 @@
+"""Metrics in the Prometheus text format.
+
+Metrics are kept in the memory of each process, and every process writes
+them to its own file in the `METRICS_DIR` directory at most once every
+`FLUSH_INTERVAL` seconds, after a request. The metrics endpoint sums the
+files of all processes, so with multiple gunicorn workers every scrape
+returns the metrics of all of them. The files of workers that exited are
+summed too, so that counters never go back, until the directory is
+cleared when gunicorn starts.
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from functools import wraps
+from pathlib import Path
+
+from flask import g, has_app_context, has_request_context, request
+
+# Default histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# Minimum number of seconds between writes of the metrics of a process
+FLUSH_INTERVAL = 1
+
+_metrics = []
+
+# The directory of the metrics files and when they were last written
+_files = {'directory': None, 'flushed': 0}
+
+
+def _escape(value):
+    value = str(value)
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        _metrics.append(self)
+
+    def _labels(self, labelvalues):
+        assert len(labelvalues) == len(self.labelnames)
+        return tuple(zip(self.labelnames, labelvalues))
+
+    def samples(self, values):
+        raise NotImplementedError
+
+    def merge(self, values, other):
+        """Add the values of another process to `values`."""
+        raise NotImplementedError
+
+    def render(self, values=None):
+        if values is None:
+            values = self.values
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for name, labels, value in self.samples(values):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        labels = self._labels(labelvalues)
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labelvalues):
+        return self.values.get(self._labels(labelvalues), 0)
+
+    def samples(self, values):
+        for labels, value in values.items():
+            yield self.name, labels, value
+
+    def merge(self, values, other):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, amount, *labelvalues):
+        labels = self._labels(labelvalues)
+        value = self.values.get(labels)
+        if value is None:
+            value = self.values[labels] = {
+                'buckets': [0] * len(self.buckets),
+                'sum': 0,
+                'count': 0,
+            }
+        index = bisect_left(self.buckets, amount)
+        if index < len(self.buckets):
+            value['buckets'][index] += 1
+        value['sum'] += amount
+        value['count'] += 1
+
+    def count(self, *labelvalues):
+        value = self.values.get(self._labels(labelvalues))
+        return value['count'] if value else 0
+
+    def time(self, *labelvalues):
+        """Return a context manager that observes its duration."""
+        return _Timer(self, labelvalues)
+
+    def samples(self, values):
+        for labels, value in values.items():
+            cumulative = 0
+            for bound, num in zip(self.buckets, value['buckets']):
+                cumulative += num
+                yield f'{self.name}_bucket', labels + (('le', bound),), \
+                    cumulative
+            yield f'{self.name}_bucket', labels + (('le', '+Inf'),), \
+                value['count']
+            yield f'{self.name}_sum', labels, value['sum']
+            yield f'{self.name}_count', labels, value['count']
+
+    def merge(self, values, other):
+        for labels, value in other.items():
+            total = values.get(labels)
+            if total is None:
+                values[labels] = {**value, 'buckets': list(value['buckets'])}
+                continue
+            total['buckets'] = [
+                a + b for a, b in zip(total['buckets'], value['buckets'])
+            ]
+            total['sum'] += value['sum']
+            total['count'] += value['count']
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self.start
+        self.histogram.observe(duration, *self.labelvalues)
+
+
+cache_hits = Counter(
+    'buzuki_cache_hits_total',
+    "Cache lookups answered without a rebuild.",
+    ('family',),
+)
+cache_misses = Counter(
+    'buzuki_cache_misses_total',
+    "Cache lookups that needed a rebuild.",
+    ('family',),
+)
+cache_rebuilds = Counter(
+    'buzuki_cache_rebuilds_total',
+    "Cache rebuilds by the endpoint that caused them.",
+    ('cache', 'endpoint'),
+)
+cache_fill_duration = Histogram(
+    'buzuki_cache_fill_duration_seconds',
+    "Duration of cache rebuilds.",
+    ('cache',),
+)
+cache_round_trips = Histogram(
+    'buzuki_cache_round_trips_per_request',
+    "Cache backend calls per request.",
+    ('endpoint',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+request_duration = Histogram(
+    'buzuki_request_duration_seconds',
+    "Request latency by endpoint.",
+    ('endpoint', 'method'),
+)
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'none'
+
+
+def fill(cache):
+    """Decorator that records the rebuilds of `cache` and their duration."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache_rebuilds.inc(cache, _endpoint())
+            with cache_fill_duration.time(cache):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_round_trip():
+    if has_app_context() and 'cache_round_trips' in g:
+        g.cache_round_trips += 1
+
+
+def _path(pid):
+    return _files['directory'] / f'{pid}.json'
+
+
+def flush():
+    """Write the metrics of this process to its file."""
+    directory = _files['directory']
+    if directory is None:
+        return
+    data = {
+        metric.name: [
+            [[list(pair) for pair in labels], value]
+            for labels, value in metric.values.items()
+        ]
+        for metric in _metrics
+    }
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _path(os.getpid())
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+    _files['flushed'] = time.monotonic()
+
+
+def clear_files():
+    """Delete the metrics files of every process."""
+    directory = _files['directory']
+    if directory is None or not directory.is_dir():
+        return
+    for path in directory.glob('*.json'):
+        path.unlink(missing_ok=True)
+
+
+def _read_files():
+    """Yield the metrics of every other process from their files."""
+    directory = _files['directory']
+    if directory is None or not directory.is_dir():
+        return
+    own = _path(os.getpid())
+    for path in directory.glob('*.json'):
+        if path == own:
+            continue
+        try:
+            data = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            continue
+        yield {
+            name: {
+                tuple(tuple(pair) for pair in labels): value
+                for labels, value in values
+            }
+            for name, values in data.items()
+        }
+
+
+def render():
+    """Render the metrics of every process."""
+    totals = {}
+    for metric in _metrics:
+        totals[metric.name] = {}
+        metric.merge(totals[metric.name], metric.values)
+    for data in _read_files():
+        for metric in _metrics:
+            metric.merge(totals[metric.name], data.get(metric.name, {}))
+    return '\n'.join(
+        metric.render(totals[metric.name]) for metric in _metrics
+    ) + '\n'
+
+
+def _forget():
+    """Forget the metrics inherited from the parent process."""
+    for metric in _metrics:
+        metric.values = {}
+    _files['flushed'] = 0
+
+
+# The parent writes its metrics before forking, i.e. the gunicorn master
+# that warmed the caches, so that they are counted once.
+os.register_at_fork(before=flush, after_in_child=_forget)
+
+
+def init_app(app):
+    _files['directory'] = Path(app.config['METRICS_DIR'])
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.cache_round_trips = 0
+
+    @app.after_request
+    def finish_request(response):
+        start = g.pop('request_start', None)
+        round_trips = g.pop('cache_round_trips', None)
+        if start is not None:
+            endpoint = _endpoint()
+            duration = time.perf_counter() - start
+            request_duration.observe(duration, endpoint, request.method)
+            cache_round_trips.observe(round_trips, endpoint)
+        if time.monotonic() - _files['flushed'] >= FLUSH_INTERVAL:
+            flush()
+        return response
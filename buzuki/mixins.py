@@ -14,7 +14,8 @@ class Model:
         """Test instance equality by comparing slugs."""
         if isinstance(other, self.__class__):
             return self.slug == other.slug
-        return False
+        # Let summaries of the model compare themselves
+        return NotImplemented
 
     def get(self):
         raise NotImplementedError
@@ -38,6 +39,14 @@ class Model:
     def url(self):
         return f'/{self.__class__.__name__.lower()}s/{self.slug}/'
 
+    @property
+    def document_id(self):
+        """The id of the object's search document, e.g. 'songs/<slug>'.
+
+        Unlike slugs, ids are unique across songs, artists and scales.
+        """
+        return self.url.strip('/')
+
     @classmethod
     def search(cls, query):
         query = unaccented(query.strip())
@@ -0,0 +1,151 @@
+"""In-memory n-gram index for searching songs, artists and scales.
+
+A name matches a query if the unaccented query is a substring of the
+unaccented name, or if the query with its whitespace replaced by
+underscores is a substring of the slug, which is what `Model.search` does
+by scanning every object.
+
+Every substring of up to `N` characters of the names and slugs is indexed,
+so queries of up to `N` characters are answered with a single lookup, and
+longer ones by intersecting the entries of their n-grams and checking the
+few candidates that remain. Results are in catalog order.
+
+Each process builds the index from its snapshot of the catalog the first
+time it's searched, and again whenever the catalog changes.
+"""
+
+import re
+
+from buzuki import cache_utils
+from buzuki.utils import unaccented
+
+# Length of the longest indexed substrings
+N = 3
+
+# Indexes of the songs and artists, along with the catalog they were
+# built from
+_current = {'index': None}
+
+
+def _ngrams(text):
+    return {
+        text[i:i + n]
+        for n in range(1, N + 1)
+        for i in range(len(text) - n + 1)
+    }
+
+
+class NgramIndex:
+    def __init__(self, entries):
+        """Index the names and slugs of `entries`, a list of pairs."""
+        self.names = []
+        self.slugs = []
+        self.name_ngrams = {}
+        self.slug_ngrams = {}
+        for i, (name, slug) in enumerate(entries):
+            name = unaccented(name)
+            self.names.append(name)
+            self.slugs.append(slug)
+            for ngram in _ngrams(name):
+                self.name_ngrams.setdefault(ngram, []).append(i)
+            for ngram in _ngrams(slug):
+                self.slug_ngrams.setdefault(ngram, []).append(i)
+
+    @staticmethod
+    def _lookup(ngrams, texts, query):
+        if len(query) <= N:
+            return ngrams.get(query, ())
+
+        postings = []
+        for i in range(len(query) - N + 1):
+            posting = ngrams.get(query[i:i + N])
+            if posting is None:
+                return ()
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return ()
+        return [i for i in candidates if query in texts[i]]
+
+    def search(self, query):
+        """Return the positions of the entries that match `query`."""
+        query = unaccented(query.strip())
+        if not query:
+            return list(range(len(self.names)))
+        slug_query = re.sub(r'\s+', '_', query)
+        matches = set(self._lookup(self.name_ngrams, self.names, query))
+        matches.update(self._lookup(self.slug_ngrams, self.slugs, slug_query))
+        return sorted(matches)
+
+
+def _get_index():
+    songs, artists = cache_utils.get_catalog()
+    index = _current['index']
+    if (
+        index is None
+        or index['songs'] is not songs
+        or index['artists'] is not artists
+    ):
+        index = _current['index'] = {
+            'songs': songs,
+            'artists': artists,
+            'song_index': NgramIndex(
+                [(song['name'], slug) for slug, song in songs.items()]
+            ),
+            'artist_index': NgramIndex(
+                [(artist['name'], slug) for slug, artist in artists.items()]
+            ),
+        }
+    return index
+
+
+def _search_songs(index, query):
+    from buzuki.songs import SongSummary
+
+    songs = index['songs']
+    slugs = index['song_index'].slugs
+    result = []
+    for i in index['song_index'].search(query):
+        song = songs[slugs[i]]
+        result.append(SongSummary(
+            song['name'], slugs[i], song['artist'], song['artist_slug'],
+            song['scale'],
+        ))
+    return result
+
+
+def _search_artists(index, query):
+    from buzuki.artists import Artist
+
+    artists = index['artists']
+    slugs = index['artist_index'].slugs
+    return [
+        Artist.frommetadata(artists[slugs[i]], slugs[i])
+        for i in index['artist_index'].search(query)
+    ]
+
+
+def search(query):
+    """Search songs, artists and scales at once.
+
+    Returns the matching songs and artists, and the scale named exactly
+    `query`, or None.
+    """
+    from buzuki.scales import SCALE_SLUGS, Scale
+
+    index = _get_index()
+    scale = Scale.get(query) if query in SCALE_SLUGS else None
+    return _search_songs(index, query), _search_artists(index, query), scale
+
+
+def search_songs(query):
+    """Return the summaries of the songs that match `query`."""
+    return _search_songs(_get_index(), query)
+
+
+def search_artists(query):
+    """Return the artists that match `query`."""
+    return _search_artists(_get_index(), query)
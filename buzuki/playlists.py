@@ -1,3 +1,4 @@
+import os
 import re
 from pathlib import Path
 from typing import Optional
@@ -6,10 +7,20 @@ import yaml
 from flask import current_app as app
 from flask import g, request
 
-from buzuki import DoesNotExist, InvalidNote
+from buzuki import DoesNotExist, InvalidNote, metrics
 from buzuki.mixins import Model
-from buzuki.songs import Song
-from buzuki.utils import unaccented
+from buzuki.songs import Song, SongSummary
+
+# Per-process index of the playlists of each song. It is validated against
+# the modification time and size of the playlist files, and only the files
+# that changed are parsed again (see `get_song_playlists`).
+_index = {
+    'directory': None,
+    'stamps': {},  # Playlist slug -> (mtime, size) of its file
+    'names': {},  # Playlist slug -> name
+    'members': {},  # Playlist slug -> song slugs
+    'songs': {},  # Song slug -> {playlist slug: root}
+}
 
 
 class Playlist(Model):
@@ -22,13 +33,13 @@ class Playlist(Model):
         self.directory.mkdir(mode=0o755, exist_ok=True)
 
     def __contains__(self, item):
-        if isinstance(item, Song):
-            return item in self.songs
+        if isinstance(item, (Song, SongSummary)):
+            return item.slug in (song.slug for song in self.songs)
         elif isinstance(item, str):
             return item in (song.slug for song in self.songs)
         else:
             raise TypeError(
-                f"'in <playlist>' requires Song or string "
+                f"'in <playlist>' requires Song, SongSummary or string "
                 f"as left operand, not {type(item)}"
             )
 
@@ -44,7 +55,13 @@ class Playlist(Model):
         songs = []
         roots = {}
         for song_data in data['songs']:
-            songs.append(Song.frommetadata(song_data))
+            songs.append(SongSummary(
+                song_data['name'],
+                song_data['slug'],
+                song_data['artist'],
+                song_data['artist_slug'],
+                root=song_data.get('root'),
+            ))
             if 'root' in song_data:
                 roots[song_data['slug']] = song_data['root']
 
@@ -85,6 +102,10 @@ class Playlist(Model):
         )
         path = self.directory / f'{self.slug}.yml'
         path.write_text(data)
+        if _index['directory'] == self.directory:
+            stat = path.stat()
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            _index_playlist(self.slug, playlist_data, stamp)
 
     def add(self, song_slug, root=None):
         if root and not re.match('^[A-G][bs]?$', root):
@@ -92,8 +113,8 @@ class Playlist(Model):
 
         self.songs = [song for song in self.songs if song.slug != song_slug]
         song = Song.get(song_slug, root=root)
-        self.songs.append(song)
-        self.songs.sort(key=lambda song: unaccented(song.name))
+        self.songs.append(SongSummary.fromsong(song))
+        self.songs.sort(key=lambda song: song.sort_key)
         self.tofile()
 
     def remove(self, song_slug):
@@ -101,6 +122,77 @@ class Playlist(Model):
         self.tofile()
 
 
+def _unindex_playlist(slug):
+    _index['stamps'].pop(slug, None)
+    _index['names'].pop(slug, None)
+    for song_slug in _index['members'].pop(slug, ()):
+        _index['songs'][song_slug].pop(slug, None)
+
+
+def _index_playlist(slug, data, stamp):
+    _unindex_playlist(slug)
+    _index['stamps'][slug] = stamp
+    _index['names'][slug] = data['name']
+    _index['members'][slug] = [song['slug'] for song in data['songs']]
+    for song_data in data['songs']:
+        playlists = _index['songs'].setdefault(song_data['slug'], {})
+        playlists[slug] = song_data.get('root')
+
+
+def _refresh_index():
+    """Bring the index up to date with the playlist files."""
+    directory: Path = app.config['DIR'] / 'playlists'
+    if _index['directory'] != directory:
+        _index['directory'] = directory
+        _index['stamps'] = {}
+        _index['names'] = {}
+        _index['members'] = {}
+        _index['songs'] = {}
+
+    stamps = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                slug, ext = os.path.splitext(entry.name)
+                if ext == '.yml':
+                    stat = entry.stat()
+                    stamps[slug] = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        pass
+
+    changed = False
+    for slug in _index['stamps'].keys() - stamps.keys():
+        _unindex_playlist(slug)
+        changed = True
+    for slug, stamp in stamps.items():
+        if _index['stamps'].get(slug) != stamp:
+            path = directory / f'{slug}.yml'
+            _index_playlist(slug, yaml.safe_load(path.read_text()), stamp)
+            changed = True
+    if changed:
+        metrics.cache_misses.inc('playlists')
+    else:
+        metrics.cache_hits.inc('playlists')
+
+
+def get_song_playlists(song_slug):
+    """Return every playlist, and whether it contains the given song.
+
+    If it does, the root of the song in the playlist is returned too.
+    """
+    _refresh_index()
+    member_of = _index['songs'].get(song_slug, {})
+    return [
+        {
+            'name': name,
+            'slug': slug,
+            'member': slug in member_of,
+            'root': member_of.get(slug),
+        }
+        for slug, name in _index['names'].items()
+    ]
+
+
 def get_selected_playlist() -> Optional[Playlist]:
     playlist = getattr(g, 'playlist', None)
     if playlist:
@@ -191,8 +191,8 @@ def get_related(slug):
         related = [slug for slug in related if slug in playlist]
         logging.debug("Filtered out not in playlist")
 
-    cached_songs = cache_utils.get_songs()
+    cached_songs = cache_utils.get_many_songs(related[:15])
     return [{
         'name': cached_songs[slug]['name'],
         'slug': slug,
-    } for slug in related[:15]]
+    } for slug in related[:15] if slug in cached_songs]
@@ -1,12 +1,43 @@
+import re
+
 import yaml
+from flask import url_for
 
 from buzuki import DoesNotExist, InvalidNote
 from buzuki.mixins import Model
-from buzuki.utils import FLATS, SHARPS, distance, greeklish, to_unicode
+from buzuki.utils import (FLATS, SHARPS, LRUCache, distance, greeklish,
+                          to_unicode)
 
 with open('buzuki/scales.yml') as f:
     SCALES = yaml.safe_load(f.read())
 
+# Slugs by scale name
+SCALE_SLUGS = {
+    scale['name']: greeklish(scale['name']) for scale in SCALES.values()
+}
+
+# Matches the name of any scale. Longer names come first, so that a name
+# that contains another one is matched as a whole.
+SCALE_PATTERN = re.compile('|'.join(
+    re.escape(name) for name in sorted(SCALE_SLUGS, key=len, reverse=True)
+))
+
+# Links to every scale by root
+_links = LRUCache(64)
+
+
+def link_scales(text: str, root: str) -> str:
+    """Wrap every scale name in `text` in a link to the scale page."""
+    root = re.sub('[#♯]', 's', root)
+    links = _links.get(root)
+    if links is None:
+        links = {}
+        for name, slug in SCALE_SLUGS.items():
+            url = url_for('main.scale', slug=slug, root=root, _external=False)
+            links[name] = f'<a href="{url}">{name}</a>'
+        _links.set(root, links)
+    return SCALE_PATTERN.sub(lambda match: links[match.group()], text)
+
 
 class Scale(Model):
     def __init__(self, name, ascending, descending, chords, structure):
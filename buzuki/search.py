@@ -0,0 +1,117 @@
+"""Search through the backend selected by the SEARCH_BACKEND setting.
+
+Both `buzuki.fulltext` and `buzuki.elastic` have the same interface, and
+return results in the shape of elasticsearch.
+
+Results are cached in each process by their normalized query, along with
+the version of the index they came from. Every write to the index through
+this module changes the version, which is kept in the cache, so that the
+results of every process are invalidated.
+"""
+
+import re
+from uuid import uuid4
+
+from flask import current_app as app
+
+from buzuki import cache, fulltext, metrics
+from buzuki.utils import LRUCache, unaccented
+
+# Maximum number of cached search results
+RESULTS_CACHE_SIZE = 1024
+
+# Search results as {(backend, query, extra): (index version, result)}
+_results = LRUCache(RESULTS_CACHE_SIZE)
+
+
+class Unavailable(Exception):
+    pass
+
+
+def _backend():
+    if app.config['SEARCH_BACKEND'] == 'elasticsearch':
+        from buzuki import elastic
+        return elastic
+    return fulltext
+
+
+def _call(name, *args):
+    backend = _backend()
+    if backend is fulltext:
+        return getattr(backend, name)(*args)
+
+    import elasticsearch
+    try:
+        return getattr(backend, name)(*args)
+    except elasticsearch.ConnectionError:
+        raise Unavailable("Couldn't connect to elasticsearch")
+
+
+def _index_version():
+    version = cache.get('search_version')
+    if version is None:
+        # The cache was cleared, so results cached before can't be trusted
+        version = uuid4().hex
+        if not cache.add('search_version', version):
+            version = cache.get('search_version')
+    return version
+
+
+def _write(name, *args):
+    """Write to the index and invalidate the cached results."""
+    try:
+        return _call(name, *args)
+    finally:
+        # Even a failed write may have changed some documents
+        cache.set('search_version', uuid4().hex)
+
+
+def create_index():
+    """Delete and create the search index again."""
+    return _write('create_index')
+
+
+def rebuild_index(items, chunk_size=500, thread_count=1):
+    """Build a new search index with `items` and swap it in when done.
+
+    Searches keep being served by the old index while it's built.
+    """
+    return _write('rebuild_index', items, chunk_size, thread_count)
+
+
+def index(item):
+    return _write('index', item)
+
+
+def index_many(items):
+    return _write('index_many', items)
+
+
+def delete_many(ids):
+    return _write('delete_many', ids)
+
+
+def delete(document_id):
+    return _write('delete', document_id)
+
+
+def search(query, extra=[]):
+    """Return the first 15 results of `query`.
+
+    Raises `Unavailable` if the search backend can't be reached.
+    """
+    key = (
+        app.config['SEARCH_BACKEND'],
+        re.sub(r'\s+', ' ', unaccented(query)).strip(),
+        tuple(extra),
+    )
+    version = _index_version()
+    cached = _results.get(key)
+    if cached is not None and cached[0] == version:
+        metrics.cache_hits.inc('search_results')
+        return cached[1]
+
+    metrics.cache_misses.inc('search_results')
+    result = _call('search', query, extra)
+    _results.set(key, (version, result))
+    return result
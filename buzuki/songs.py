@@ -1,14 +1,36 @@
+import os
 import re
-from pathlib import Path
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path, PurePosixPath
+from stat import S_ISREG
 from urllib.parse import parse_qs, urlparse
 
 from flask import current_app as app
-from flask import url_for
 
-from buzuki import DoesNotExist, cache_utils
+from buzuki import (DoesNotExist, InvalidSong, cache_utils, indexer, metrics,
+                    ngram)
 from buzuki.mixins import Model
-from buzuki.scales import Scale
-from buzuki.utils import greeklish, to_unicode, transpose, transpose_to_root
+from buzuki.scales import link_scales
+from buzuki.utils import (ChordSheet, LRUCache, distance, greeklish,
+                          to_unicode, transpose, unaccented)
+
+# Maximum number of parsed songs to keep in memory.
+PARSED_CACHE_SIZE = 512
+
+# Number of threads used to load song files in bulk (see `Song.iterfiles`).
+LOAD_WORKERS = 8
+
+# Maximum number of transpositions, including the tokenized body, to keep
+# for each parsed song.
+VARIANTS_PER_SONG = 8
+
+# Parsed songs by path, along with the mtime and size of their file and
+# their transpositions and tokenized body (see `Song.get`).
+_parsed = LRUCache(PARSED_CACHE_SIZE)
 
 
 class Song(Model):
@@ -23,8 +45,9 @@ class Song(Model):
         self.rhythm = rhythm
         self.body = body
         self.root = root
+        # Cached transposition that this song was loaded as, if any
+        self._variant = None
         self.directory: Path = app.config['DIR'] / 'songs'
-        self.directory.mkdir(mode=0o755, exist_ok=True)
 
     @classmethod
     def get(cls, slug, semitones=None, root=None, unicode=False):
@@ -35,30 +58,103 @@ class Song(Model):
             semitones: Transpose song by given semitones.
             root: Transpose song to the given root.
             unicode: Use unicode sharps and flats in the song's body.
+
+        Transpositions are cached along with the parsed song, so they are
+        computed once for every song and key, until the file changes. Only
+        the `VARIANTS_PER_SONG` most recently used ones are kept.
         """
-        song = cls.fromfile(filename=slug)
+        song, variants = cls._load(slug)
         assert song.body is not None
-        if semitones is not None:
-            song.scale = transpose(song.scale, semitones)
-            song.body = transpose(song.body, semitones)
-        elif root is not None:
+        if semitones is None and root is not None:
             root = re.sub('s', '#', root)
+            # Roots are resolved to semitones, so that every spelling of a
+            # root shares the transposition by the same semitones.
             old_root = song.scale[0:2].strip()
-            song.scale = transpose_to_root(song.scale, old_root, root)
-            song.body = transpose_to_root(song.body, old_root, root)
+            semitones = distance(root) - distance(old_root)
             song.root = root
+
+        if semitones is not None:
+            # Transposing by 12 semitones gives the same result
+            key = (semitones % 12, unicode)
+        else:
+            key = (None, unicode)
+
+        variant = variants.get(key)
+        if variant is not None:
+            metrics.cache_hits.inc('transpositions')
+            song.scale = variant['scale']
+            song._body = variant['body']
+            song._variant = variant
+            return song
+
+        metrics.cache_misses.inc('transpositions')
+        if semitones is not None:
+            # The body is tokenized once for all transpositions
+            sheet = variants.get('sheet')
+            if sheet is None:
+                sheet = ChordSheet(song.body)
+                variants.set('sheet', sheet)
+            song.scale = transpose(song.scale, semitones)
+            song.body = sheet.transpose(semitones)
         if unicode:
             song.scale = to_unicode(song.scale)
             song.body = to_unicode(song.body)
 
+        song._variant = {'scale': song.scale, 'body': song.body}
+        variants.set(key, song._variant)
         return song
 
     @classmethod
     def fromfile(cls, filename):
+        """Load a song from file."""
+        song, _ = cls._load(filename)
+        return song
+
+    @classmethod
+    def _load(cls, filename):
+        """Load a song from file, along with its cached transpositions.
+
+        Parsed songs are kept in an LRU cache, which is validated against
+        the modification time and size of the file, so that popular songs
+        are neither read nor parsed again.
+        """
         path: Path = app.config['DIR'] / 'songs' / filename
-        if not path.is_file():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            stat = None
+        if stat is None or not S_ISREG(stat.st_mode):
             raise DoesNotExist(f"Song '{filename}' does not exist")
-        file = path.read_text()
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = _parsed.get(str(path))
+        if cached is not None and cached[0] == stamp:
+            metrics.cache_hits.inc('song_files')
+            _, fields, variants = cached
+            *fields, body = fields
+            song = cls(*fields, body=None)
+            # The body is already normalized
+            song._body = body
+            return song, variants
+
+        metrics.cache_misses.inc('song_files')
+        song = cls._parse(path)
+        fields = (
+            song.name, song.year, song.artist, song.link, song.scale,
+            song.rhythm, song.body,
+        )
+        variants = LRUCache(VARIANTS_PER_SONG)
+        _parsed.set(str(path), (stamp, fields, variants))
+        return song, variants
+
+    @classmethod
+    def _parse(cls, path: Path):
+        """Parse a song file."""
+        return cls._fromtext(path.read_text())
+
+    @classmethod
+    def _fromtext(cls, file: str):
+        """Parse the contents of a song file."""
         name, artist, link, rest = [x for x in file.split('\n', 3)]
         name_parts = name.split(' (')
         if len(name_parts) == 2:
@@ -68,8 +164,74 @@ class Song(Model):
             assert len(name_parts) == 1
             year = None
         scale, rhythm, body = rest.strip('\n').split('\n\n', 2)
-        song = cls(name, year, artist, link, scale, rhythm, body)
-        return song
+        return cls(name, year, artist, link, scale, rhythm, body)
+
+    @staticmethod
+    def filenames():
+        """Return the sorted filenames of every song.
+
+        The temporary files of songs being written are skipped.
+        """
+        directory: Path = app.config['DIR'] / 'songs'
+        return sorted(
+            name for name in os.listdir(directory) if not name.startswith('.')
+        )
+
+    @classmethod
+    def iterfiles(
+        cls, filenames=None, ordered=False, fields=None, workers=LOAD_WORKERS
+    ):
+        """Load song files in a thread pool and yield them one by one.
+
+        At most twice as many files as there are workers are loaded ahead
+        of the consumer, so memory stays flat however many songs there
+        are. Songs are parsed from disk, bypassing the parsed song cache.
+
+        Args:
+            filenames: The files to load, every song file by default.
+            ordered: Yield songs in the order of `filenames`, instead of
+                as soon as each one is loaded.
+            fields: Yield dicts with only the given attributes instead of
+                songs.
+            workers: Number of threads.
+        """
+        directory: Path = app.config['DIR'] / 'songs'
+        if filenames is None:
+            filenames = cls.filenames()
+        filenames = iter(filenames)
+        flask_app = app._get_current_object()
+
+        def load(filename):
+            with flask_app.app_context():
+                song = cls._parse(directory / filename)
+                if fields is None:
+                    return song
+                return {field: getattr(song, field) for field in fields}
+
+        pending = deque() if ordered else set()
+        with ThreadPoolExecutor(workers) as executor:
+            def submit(num):
+                for filename in islice(filenames, num):
+                    future = executor.submit(load, filename)
+                    if ordered:
+                        pending.append(future)
+                    else:
+                        pending.add(future)
+
+            try:
+                submit(2 * workers)
+                while pending:
+                    if ordered:
+                        future = pending.popleft()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        future = done.pop()
+                        pending.remove(future)
+                    submit(1)
+                    yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
 
     @classmethod
     def frommetadata(cls, song):
@@ -89,14 +251,24 @@ class Song(Model):
         """Get all songs from the database.
 
         Args:
-            frommetadata: Use cached song data instead of hitting the disk.
+            frommetadata: Return summaries of the cached song data instead
+                of hitting the disk.
         """
         if frommetadata:
-            songs = cache_utils.get_songs().values()
-            return [cls.frommetadata(song) for song in songs]
+            return [
+                SongSummary(
+                    song['name'], slug, song['artist'], song['artist_slug'],
+                    song['scale'],
+                )
+                for slug, song in cache_utils.get_songs().items()
+            ]
         else:
-            directory = app.config['DIR'] / 'songs'
-            return [Song.get(path.name) for path in directory.iterdir()]
+            return list(cls.iterfiles())
+
+    @classmethod
+    def search(cls, query):
+        """Return the summaries of the songs that match `query`."""
+        return iter(ngram.search_songs(query))
 
     @property
     def youtube_id(self):
@@ -134,15 +306,21 @@ class Song(Model):
         _scale = self.scale
 
         if html:
-            root = _scale[0:2].strip()
-            root = re.sub('[#♯]', 's', root)
-            for scale in Scale.all():
-                if scale.name in _scale:
-                    url = url_for('main.scale', slug=scale.slug, root=root)
-                    href = f'<a href="{url}">{scale.name}</a>'
-                    _scale = _scale.replace(scale.name, href)
+            # Reuse the info of the cached transposition, unless the
+            # song was modified after loading it.
+            variant = self._variant
+            fields = (self.scale, self.rhythm, self._body)
+            if variant is not None and 'info' in variant:
+                cached_fields, info = variant['info']
+                if all(a is b for a, b in zip(cached_fields, fields)):
+                    return info
+
+            _scale = link_scales(_scale, _scale[0:2].strip())
 
-        return '\n\n'.join([_scale, self.rhythm, self._body])
+        info = '\n\n'.join([_scale, self.rhythm, self._body])
+        if html and self._variant is not None:
+            self._variant['info'] = (fields, info)
+        return info
 
     @property
     def body(self):
@@ -163,37 +341,55 @@ class Song(Model):
     def artist_slug(self):
         return greeklish(self.artist)
 
+    @property
+    def sort_key(self):
+        """The key that songs are sorted by."""
+        return unaccented(self.name)
+
     @property
     def playlists(self):
-        from buzuki.playlists import Playlist
+        from buzuki.playlists import get_song_playlists
 
-        playlists = []
-        for playlist in Playlist.all():
-            matches = [
-                song for song in playlist.songs if song.slug == self.slug
-            ]
-            match = matches[0] if matches else None
+        return get_song_playlists(self.slug)
 
-            playlists.append({
-                'name': playlist.name,
-                'slug': playlist.slug,
-                'member': match is not None,
-                'root': match.root if match is not None else None,
-            })
+    def tofile(self):
+        autoindex = app.config['SEARCH_AUTOINDEX']
+        # The artist of the song may have changed, and both the old and
+        # the new artist have to be indexed again. They are taken from the
+        # catalog, which has them as they are read from the file.
+        old = cache_utils.get_song(self.slug) if autoindex else None
+        self._write()
+        cache_utils.update_song(self)
+        if autoindex:
+            new = cache_utils.get_song(self.slug)
+            artists = {song['artist_slug'] for song in [old, new] if song}
+            indexer.enqueue(songs=[self.slug], artists=artists)
 
-        return playlists
+    def _write(self):
+        """Write the song to its file, without updating the caches.
 
-    def tofile(self):
+        The file is replaced atomically, so readers never see a partially
+        written song.
+        """
+        self.directory.mkdir(mode=0o755, exist_ok=True)
         path: Path = self.directory / self.slug
         name = f"{self.name} ({self.year})" if self.year else self.name
         content = [name, self.artist, self.link, '', self.info(), '']
-        path.write_text('\n'.join(content))
-        cache_utils.clear()
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_text('\n'.join(content))
+        os.replace(tmp_path, path)
+        _parsed.pop(str(path))
 
     def delete(self):
+        autoindex = app.config['SEARCH_AUTOINDEX']
+        old = cache_utils.get_song(self.slug) if autoindex else None
         path: Path = self.directory / self.slug
         path.unlink()
-        cache_utils.clear()
+        _parsed.pop(str(path))
+        cache_utils.remove_song(self.slug)
+        if autoindex:
+            artists = [old['artist_slug']] if old else []
+            indexer.enqueue(songs=[self.slug], artists=artists)
 
     @staticmethod
     def delete_all():
@@ -203,7 +399,57 @@ class Song(Model):
         path: Path
         for path in directory.iterdir():
             path.unlink()
-        cache_utils.clear()
+        _parsed.clear()
+        cache_utils.refill()
+
+    @classmethod
+    def bulk_import(cls, source: Path, index=True):
+        """Import the song files of a directory or an archive.
+
+        Every file is parsed before any song is written, so if one of them
+        is invalid nothing is imported. The catalog cache is refilled once
+        after all songs are written, holding the lock of the catalog.
+        Unless `index` is false, the documents of the songs and of their
+        old and new artists are then updated at once.
+
+        Returns the imported songs and the slugs of the songs that already
+        existed and were overwritten.
+
+        Raises `InvalidSong` if a file can't be parsed or two files have
+        the same slug.
+        """
+        files = _read_song_files(source)
+        songs = {}
+        errors = []
+        for filename, data in files:
+            try:
+                song = cls._fromtext(data.decode())
+            except (ValueError, AssertionError):
+                errors.append(f"{filename}: Not a song file")
+                continue
+            if not song.slug:
+                errors.append(f"{filename}: Song has no name")
+            elif song.slug in songs:
+                errors.append(
+                    f"{filename}: Song '{song.slug}' is already imported"
+                )
+            else:
+                songs[song.slug] = song
+        if errors:
+            raise InvalidSong('\n'.join(errors))
+
+        # The artists of overwritten songs may change, and the old ones
+        # have to be indexed again too.
+        old = cache_utils.get_many_songs(songs)
+        for song in songs.values():
+            song._write()
+        cache_utils.refill()
+
+        if index:
+            artists = {song['artist_slug'] for song in old.values()}
+            artists.update(song.artist_slug for song in songs.values())
+            indexer.update(songs=songs, artists=artists)
+        return list(songs.values()), sorted(old)
 
     @property
     def audio_path(self):
@@ -211,3 +457,98 @@ class Song(Model):
 
     def has_audio(self):
         return self.audio_path.is_file()
+
+
+def _read_song_files(source: Path) -> list:
+    """Return the names and data of the files in a directory or archive.
+
+    Directories within the source and hidden files are skipped.
+    """
+    def visible(name):
+        return not name.startswith('.')
+
+    if source.is_dir():
+        return [
+            (path.name, path.read_bytes())
+            for path in sorted(source.iterdir())
+            if path.is_file() and visible(path.name)
+        ]
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            return [
+                (name, archive.read(info))
+                for info in archive.infolist()
+                if not info.is_dir()
+                and visible(name := PurePosixPath(info.filename).name)
+            ]
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            return [
+                (name, archive.extractfile(member).read())
+                for member in archive
+                if member.isfile()
+                and visible(name := PurePosixPath(member.name).name)
+            ]
+    else:
+        raise InvalidSong(f"'{source}' is not a directory or an archive")
+
+
+class SongSummary:
+    """The fields of a song that song lists show.
+
+    Summaries are read-only and their slugs are given instead of being
+    derived from their names, so listing the whole catalog is cheap. They
+    compare equal to the songs they summarize.
+    """
+
+    __slots__ = (
+        'name', 'slug', 'artist', 'artist_slug', 'scale', 'root', '_sort_key',
+    )
+
+    def __init__(
+        self, name, slug, artist=None, artist_slug=None, scale=None,
+        root=None,
+    ):
+        init = super().__setattr__
+        init('name', name)
+        init('slug', slug)
+        init('artist', artist)
+        init('artist_slug', artist_slug)
+        init('scale', scale)
+        init('root', root)
+        init('_sort_key', None)
+
+    @classmethod
+    def fromsong(cls, song):
+        return cls(
+            song.name, song.slug, song.artist, song.artist_slug, song.scale,
+            song.root,
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self!r} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self!r} is read-only")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} '{self.slug}'>"
+
+    def __eq__(self, other):
+        if isinstance(other, (SongSummary, Song)):
+            return self.slug == other.slug
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.slug)
+
+    @property
+    def sort_key(self):
+        """The key that songs are sorted by."""
+        if self._sort_key is None:
+            super().__setattr__('_sort_key', unaccented(self.name))
+        return self._sort_key
+
+    @property
+    def url(self):
+        return f'/songs/{self.slug}/'
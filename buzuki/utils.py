@@ -1,6 +1,9 @@
 import json
 import re
+import threading
 import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
 
 from flask import request
 
@@ -23,31 +26,72 @@ def distance(note: str) -> int:
         raise InvalidNote(f"'{note}' is not a valid note")
 
 
+# Enharmonic notes that are in neither SHARPS nor FLATS
+ENHARMONICS = {'E#': 'F', 'B#': 'C', 'Fb': 'E', 'Cb': 'B'}
+
+CHORD_PATTERN = re.compile(r'([A-G][#b]?)([^A-G\s]*)(\s*)')
+
+
+class ChordSheet:
+    """A song's text tokenized into lyrics and chords.
+
+    Each line is a list of tokens, which are either strings that are kept
+    as is, or chords in the form (pitch, note length, rest of the chord,
+    spaces after the chord), where pitch is the distance from D. Parsing
+    happens once, and transposing is an offset on the pitch of each chord
+    and a pass that keeps the chords aligned to the lyrics.
+    """
+
+    def __init__(self, text: str):
+        self.flats = re.search(r'[DEGAB]b', text) is not None
+        self.lines = [self._tokenize(line) for line in text.split('\n')]
+
+    @staticmethod
+    def _tokenize(line):
+        tokens = []
+        end = 0
+        for match in CHORD_PATTERN.finditer(line):
+            if match.start() > end:
+                tokens.append(line[end:match.start()])
+            note, chord, spaces = match.groups()
+            pitch = distance(ENHARMONICS.get(note, note))
+            tokens.append((pitch, len(note), chord, len(spaces)))
+            end = match.end()
+        if end < len(line):
+            tokens.append(line[end:])
+        return tokens
+
+    def transpose(self, num: int) -> str:
+        """Return the text transposed by `num` semitones.
+
+        Notes are spelled with flats if the text has any flats, otherwise
+        with sharps.
+        """
+        notes = FLATS if self.flats else SHARPS
+        new_lines = []
+        for tokens in self.lines:
+            carry = 0
+            parts = []
+            for token in tokens:
+                if isinstance(token, str):
+                    parts.append(token)
+                    continue
+                pitch, length, chord, spaces = token
+                new = notes[(pitch + num) % 12]
+                # Shrink or grow the following spaces so that the next
+                # chords stay in place, if there is enough space.
+                carry += length - len(new)
+                carry, spaces = sorted((0, carry + spaces))
+                parts.append(new)
+                parts.append(chord)
+                parts.append(' ' * spaces)
+            new_lines.append(''.join(parts).rstrip())
+        return '\n'.join(new_lines)
+
+
 def transpose(song: str, num: int) -> str:
     """Transpose `song` by `num` semitones."""
-    def chordrepl(matchobj):
-        """Chord replace function."""
-        nonlocal carry
-        note = matchobj.group(1)
-        chord = matchobj.group(2)
-        spaces = len(matchobj.group(3))
-        # FIXME: Raises ValueError if a song has both sharps and flats
-        idx = (notes.index(note) + num) % 12
-        new = notes[idx]
-        carry += len(note) - len(new)
-        carry, spaces = sorted((0, carry + spaces))
-        return ''.join([new, chord, ' ' * spaces])
-
-    # FIXME: Assumes that both sharp and flat notes cannot coexist
-    notes = FLATS if re.search(r'[DEGAB]b', song) else SHARPS
-    lines = song.split('\n')
-    pattern = r'([A-G][#b]?)([^A-G\s]*)(\s*)'
-    new_song = []
-    for line in lines:
-        carry = 0
-        new_line = re.sub(pattern, chordrepl, line)
-        new_song.append(new_line.rstrip())
-    return '\n'.join(new_song)
+    return ChordSheet(song).transpose(num)
 
 
 def transpose_to_root(song: str, old_root: str, new_root: str) -> str:
@@ -56,34 +100,54 @@ def transpose_to_root(song: str, old_root: str, new_root: str) -> str:
     return transpose(song, diff)
 
 
-def greeklish(string: str) -> str:
-    """Create greeklish slugs."""
-    string = string.lower()
+# Size of the memo caches of `greeklish` and `unaccented`, which are called
+# with the same names over and over.
+NORMALIZE_CACHE_SIZE = 8192
 
-    # Digraphs
-    string = re.sub('ψ', 'ps', string)
-    string = re.sub('ξ', 'ks', string)
-    string = re.sub('θ', 'th', string)
-    string = re.sub('ο[υύ]', 'ou', string)
-    string = re.sub('α[υύ]', 'au', string)
-    string = re.sub('ε[υύ]', 'eu', string)
 
-    # Rest letters
-    gr_chars = 'αβγδεζηικλμνοπρσςτυφχωάέήίόύώϊΐ '
-    en_chars = 'avgdeziiklmnoprsstyfxoaeiioyoii_'
-    table = str.maketrans(gr_chars, en_chars)
-    string = string.translate(table)
+class _GreeklishTable(dict):
+    """Translation table that deletes the characters it doesn't map."""
 
-    # Remove all the rest.
-    string = re.sub('[^a-z_]', '', string)
+    def __missing__(self, key):
+        return None
 
-    return string
 
+_GREEKLISH_TABLE = _GreeklishTable(str.maketrans(
+    'αβγδεζηικλμνοπρσςτυφχωάέήίόύώϊΐ ',
+    'avgdeziiklmnoprsstyfxoaeiioyoii_',
+))
+_GREEKLISH_TABLE.update({
+    ord('ψ'): 'ps',
+    ord('ξ'): 'ks',
+    ord('θ'): 'th',
+})
+_GREEKLISH_TABLE.update(
+    (ord(char), char) for char in 'abcdefghijklmnopqrstuvwxyz_'
+)
+
+# The υ of the ου, αυ and ευ digraphs becomes a u instead of a y.
+_DIGRAPH_PATTERN = re.compile('(?<=[οαε])[υύ]')
 
+_COMBINING_PATTERN = re.compile(r'[\u0300-\u036f]')
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def greeklish(string: str) -> str:
+    """Create greeklish slugs."""
+    string = string.lower()
+    if 'υ' in string or 'ύ' in string:
+        string = _DIGRAPH_PATTERN.sub('u', string)
+    # Transliterate and remove everything else in one pass.
+    return string.translate(_GREEKLISH_TABLE)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def unaccented(string: str) -> str:
     """Return `string` lowercase and unaccented."""
     string = string.lower()
-    return re.sub(r'[\u0300-\u036f]', '', unicodedata.normalize('NFD', string))
+    if string.isascii():
+        return string
+    return _COMBINING_PATTERN.sub('', unicodedata.normalize('NFD', string))
 
 
 def to_unicode(string: str) -> str:
@@ -97,3 +161,46 @@ def to_unicode(string: str) -> str:
 def get_latest_songs():
     cookie = request.cookies.get('latest_songs')
     return json.loads(cookie) if cookie else []
+
+
+class LRUCache:
+    """A dict-like cache that holds at most `maxsize` items.
+
+    When full, the least recently used item is evicted. It's safe to use
+    from multiple threads, i.e. request threads and `buzuki.indexer`.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -9,6 +9,7 @@ from flask import current_app as app
 from flask import (redirect, render_template, request, send_from_directory,
                    session, url_for)
 
+from buzuki import ngram
 from buzuki.artists import Artist
 from buzuki.decorators import (add_slug_to_cookie, delete_cookie,
                                login_required, set_cookie)
@@ -204,8 +205,8 @@ def playlist(slug):
 def complement(slug):
     """A list of all songs in a given playlist."""
     playlist = Playlist.get_or_404(slug)
-    all_songs = Song.all()
-    songs = [song for song in all_songs if song not in playlist.songs]
+    slugs = {song.slug for song in playlist.songs}
+    songs = [song for song in Song.all() if song.slug not in slugs]
     return render_template(
         'index.html',
         title=playlist.name,
@@ -220,7 +221,7 @@ def search():
     if not query:
         return redirect(url_for('main.index'))
 
-    songs = list(Song.search(query))
+    songs, artists, scale = ngram.search(query)
 
     if len(songs) > 1:
         return render_template(
@@ -233,8 +234,6 @@ def search():
     if len(songs) == 1:
         return redirect(url_for('main.song', slug=songs[0].slug))
 
-    artists = list(Artist.search(query))
-
     if len(artists) > 1:
         return render_template(
             'list.html',
@@ -247,8 +246,7 @@ def search():
     if len(artists) == 1:
         return redirect(url_for('main.artist', slug=artists[0].slug))
 
-    if any(scale.name == query for scale in Scale.all()):
-        scale = Scale.get(query)
+    if scale is not None:
         return redirect(url_for('main.scale', slug=scale.slug))
 
     abort(404)
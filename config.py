@@ -10,9 +10,32 @@ class Config:
     DIR = Path(os.environ.get('BUZUKI_DIR', TESTDIR))
     LOGFILE = Path('/var/log/buzuki.log')
 
+    # One of 'redis', 'simple', 'filesystem' or 'shm'. The 'simple' cache
+    # lives in the memory of each process, so it's only correct with a
+    # single worker.
+    CACHE_TYPE = os.environ.get('BUZUKI_CACHE', 'redis')
+    CACHE_REDIS_HOST = os.environ.get('BUZUKI_REDIS_HOST', 'localhost')
+    CACHE_REDIS_PORT = int(os.environ.get('BUZUKI_REDIS_PORT', 6379))
+    CACHE_KEY_PREFIX = 'buzuki_cache_'
+    CACHE_THRESHOLD = 100000
+    CACHE_DIR = Path('/tmp/buzuki_cache/')
+    CACHE_SHM_DIR = Path('/dev/shm/buzuki_cache/')
+
+    # Metrics files of every process (see `buzuki.metrics`)
+    METRICS_DIR = Path('/dev/shm/buzuki_metrics/')
+
+    # Either 'sqlite' for the embedded index of `buzuki.fulltext`, or
+    # 'elasticsearch'.
+    SEARCH_BACKEND = os.environ.get('BUZUKI_SEARCH', 'sqlite')
+    SEARCH_DB = DIR / 'search.sqlite3'
+    # Update the search index in the background when songs are written
+    # (see `buzuki.indexer`).
+    SEARCH_AUTOINDEX = True
+
 
 class DevelopmentConfig(Config):
     LOGFILE = Path('/tmp/buzuki.log')
+    METRICS_DIR = Path('/tmp/buzuki_metrics/')
 
 
 class TestingConfig(Config):
@@ -20,8 +43,13 @@ class TestingConfig(Config):
     SECRET_KEY = 'sekrit'
     DIR = Path(TESTDIR)
     LOGFILE = Path('/tmp/buzuki.log')
+    SEARCH_BACKEND = 'sqlite'
+    SEARCH_DB = DIR / 'search.sqlite3'
+    SEARCH_AUTOINDEX = False
+    METRICS_DIR = DIR / 'metrics'
     SERVER_NAME = 'localhost.localdomain'
     TESTING = True
+    CACHE_TYPE = 'simple'
     WTF_CSRF_ENABLED = False
 
 
@@ -3,9 +3,15 @@
 import json
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+import unicodedata
+from itertools import chain
 from multiprocessing import cpu_count
+from operator import itemgetter
 from pathlib import Path
 from string import printable
 
@@ -22,14 +28,16 @@ from mutagen.id3 import COMM, ID3
 from pygments import formatters, highlight, lexers
 from werkzeug.security import generate_password_hash
 
-from buzuki import DoesNotExist, cache_utils, create_app, elastic
+from buzuki import (DoesNotExist, InvalidSong, cache_utils, create_app,
+                    make_cache, metrics)
+from buzuki import search as search_index
 from buzuki.artists import Artist
 from buzuki.elastic import es
 from buzuki.playlists import Playlist
 from buzuki.related import generate_related
 from buzuki.scales import Scale
 from buzuki.songs import Song
-from buzuki.utils import FLATS, SHARPS, unaccented
+from buzuki.utils import FLATS, SHARPS, ChordSheet, greeklish, unaccented
 
 environment = (
     'production'
@@ -96,13 +104,35 @@ def gunicorn(workers, host, port):
             assert isinstance(self.cfg, GunicornConfig)
             self.cfg.set('bind', f'{host}:{port}')
             self.cfg.set('workers', workers)
+            # Load the app and warm the caches once, in the master process.
+            self.cfg.set('preload_app', True)
 
         def load(self):
-            return create_app('production')
+            app = create_app('production')
+            # Metrics of a previous run
+            metrics.clear_files()
+            with app.app_context():
+                cache_utils.warm()
+            return app
 
     GunicornApplication().run()
 
 
+@cli.command()
+def warm():
+    """Fill the catalog, related and static file caches."""
+    cache_utils.warm()
+
+
+@cli.command()
+def refill():
+    """Fill the catalog cache again from the song files.
+
+    Run by the watcher script when song files change outside buzuki.
+    """
+    cache_utils.refill()
+
+
 @cli.command()
 @click.argument('password')
 def hash(password):
@@ -125,18 +155,53 @@ def filenames():
 
 
 @cli.command()
-def index():
-    """Index all data into elasticsearch."""
-    elastic.create_index()
+@click.option(
+    '--chunk-size', default=500, show_default=True,
+    help="Documents per bulk request.",
+)
+@click.option(
+    '--threads', default=cpu_count(), show_default=True,
+    help="Bulk requests to send in parallel (elasticsearch only).",
+)
+def index(chunk_size, threads):
+    """Index all data for search.
 
-    def index_all(items, name):
-        with click.progressbar(items, label=f"Indexing {name}") as bar:
-            for item in bar:
-                elastic.index(item)
+    A new index is built and replaces the old one when it's complete, so
+    search keeps working meanwhile.
+    """
+    filenames = Song.filenames()
+    artists = Artist.all()
+    scales = Scale.all()
+    items = chain(Song.iterfiles(filenames), artists, scales)
+    with click.progressbar(
+        items,
+        length=len(filenames) + len(artists) + len(scales),
+        label="Indexing",
+    ) as bar:
+        search_index.rebuild_index(bar, chunk_size, threads)
+
+
+@cli.command('import')
+@click.argument('source', type=click.Path(exists=True, path_type=Path))
+@click.option(
+    '--no-index', is_flag=True, help="Don't update the search index."
+)
+def import_songs(source, no_index):
+    """Import songs from a directory or an archive.
 
-    index_all(Song.all(frommetadata=False), 'songs')
-    index_all(Artist.all(), 'artists')
-    index_all(Scale.all(), 'scales')
+    The song files are validated before any of them is written. The cache
+    is filled and the songs and their artists are indexed once, after all
+    songs are written.
+    """
+    try:
+        songs, overwritten = Song.bulk_import(source, index=not no_index)
+    except InvalidSong as e:
+        sys.exit(str(e))
+    click.echo(f"Imported {len(songs)} songs")
+    if overwritten:
+        click.echo(f"Overwrote {len(overwritten)} songs:")
+        for slug in overwritten:
+            click.echo(f"  {slug}")
 
 
 @cli.command()
@@ -144,8 +209,8 @@ def index():
 @click.option('-a', '--artists', is_flag=True, help="Only search for artists.")
 @click.option('-v', '--verbose', is_flag=True, help="Print whole documents.")
 def search(query, artists, verbose):
-    """Perform a search in elasticsearch."""
-    result = elastic.search(query, ['url:artists'] if artists else [])
+    """Perform a search."""
+    result = search_index.search(query, ['url:artists'] if artists else [])
     hits = result['hits']['hits']
     if verbose:
         pprint(hits)
@@ -198,6 +263,194 @@ def cache(artists, songs):
         pprint(songs)
 
 
+@cli.group()
+def bench():
+    """Run benchmarks."""
+
+
+def timeit(func, number):
+    """Return the average duration of `func` in microseconds."""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+@bench.command('cache')
+@click.argument('types', nargs=-1)
+@click.option('-n', '--number', default=1000, help="Number of repetitions.")
+def bench_cache(types, number):
+    """Compare the latency of cache backends.
+
+    By default 'redis', 'simple', 'filesystem' and 'shm' are compared.
+    Each backend is filled in its own redis namespace or temporary
+    directory, so the cache that buzuki is using is left untouched.
+    """
+    from buzuki import cache
+
+    types = types or ['redis', 'simple', 'filesystem', 'shm']
+    backend = cache.backend
+    snapshot = cache_utils._snapshot
+    slugs = []
+    shm = Path('/dev/shm')
+    directories = {
+        'CACHE_DIR': tempfile.mkdtemp(prefix='buzuki_bench_'),
+        'CACHE_SHM_DIR': tempfile.mkdtemp(
+            prefix='buzuki_bench_', dir=shm if shm.is_dir() else None
+        ),
+    }
+    config = {
+        **app.config,
+        **directories,
+        'CACHE_KEY_PREFIX': 'buzuki_bench_',
+    }
+
+    def cold_get_songs():
+        cache_utils._set_snapshot(None, None, None)
+        cache_utils.get_songs()
+
+    def get_related():
+        cache_utils.get_related(slugs[0])
+        slugs.append(slugs.pop(0))
+
+    click.echo(f"{'backend':<12}{'get_songs':>12}{'cold':>12}{'related':>12}")
+    try:
+        for cache_type in types:
+            cache.backend = make_cache(cache_type, config)
+            cache.clear()
+            cache_utils._set_snapshot(None, None, None)
+            slugs[:] = cache_utils.get_songs() or ['']
+            cache_utils.get_related(slugs[0])
+            results = [
+                timeit(cache_utils.get_songs, number),
+                timeit(cold_get_songs, number),
+                timeit(get_related, number),
+            ]
+            click.echo(f"{cache_type:<12}" + ''.join(
+                f"{f'{result:.1f} µs':>12}" for result in results
+            ))
+            cache.clear()
+    finally:
+        cache.backend = backend
+        cache_utils._set_snapshot(*snapshot)
+        for directory in directories.values():
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def legacy_transpose(song, num):
+    """The regex based `transpose` that `ChordSheet` replaced."""
+    def chordrepl(matchobj):
+        nonlocal carry
+        note = matchobj.group(1)
+        chord = matchobj.group(2)
+        spaces = len(matchobj.group(3))
+        idx = (notes.index(note) + num) % 12
+        new = notes[idx]
+        carry += len(note) - len(new)
+        carry, spaces = sorted((0, carry + spaces))
+        return ''.join([new, chord, ' ' * spaces])
+
+    notes = FLATS if re.search(r'[DEGAB]b', song) else SHARPS
+    new_song = []
+    for line in song.split('\n'):
+        carry = 0
+        new_line = re.sub(r'([A-G][#b]?)([^A-G\s]*)(\s*)', chordrepl, line)
+        new_song.append(new_line.rstrip())
+    return '\n'.join(new_song)
+
+
+def legacy_greeklish(string):
+    """The regex based `greeklish` that the translation table replaced."""
+    string = string.lower()
+    string = re.sub('ψ', 'ps', string)
+    string = re.sub('ξ', 'ks', string)
+    string = re.sub('θ', 'th', string)
+    string = re.sub('ο[υύ]', 'ou', string)
+    string = re.sub('α[υύ]', 'au', string)
+    string = re.sub('ε[υύ]', 'eu', string)
+    gr_chars = 'αβγδεζηικλμνοπρσςτυφχωάέήίόύώϊΐ '
+    en_chars = 'avgdeziiklmnoprsstyfxoaeiioyoii_'
+    string = string.translate(str.maketrans(gr_chars, en_chars))
+    return re.sub('[^a-z_]', '', string)
+
+
+def legacy_unaccented(string):
+    """The `unaccented` that the translation table replaced."""
+    string = string.lower()
+    return re.sub(r'[\u0300-\u036f]', '', unicodedata.normalize('NFD', string))
+
+
+@bench.command('greeklish')
+@click.option('-n', '--number', default=100, help="Number of repetitions.")
+def bench_greeklish(number):
+    """Compare text normalization on every song and artist name.
+
+    'single-pass' is the new implementation without its memo cache, and
+    'memoized' with it.
+    """
+    names = []
+    for song in cache_utils.get_songs().values():
+        names.append(song['name'])
+        names.append(song['artist'])
+
+    for func, legacy in [
+        (greeklish, legacy_greeklish),
+        (unaccented, legacy_unaccented),
+    ]:
+        uncached = func.__wrapped__
+        for name in names:
+            assert uncached(name) == legacy(name)
+
+        def run(f):
+            return lambda: [f(name) for name in names]
+
+        click.echo(f"{func.__name__} ({len(names)} names)")
+        for label, f in [
+            ('legacy', legacy),
+            ('single-pass', uncached),
+            ('memoized', func),
+        ]:
+            result = timeit(run(f), number) / 1000
+            click.echo(f"  {label:<12}{result:.2f} ms")
+
+
+@bench.command('transpose')
+@click.option('-n', '--number', default=100, help="Number of repetitions.")
+def bench_transpose(number):
+    """Compare transposing all songs to all 12 keys.
+
+    Songs with both sharps and flats are skipped, because the legacy
+    implementation can't transpose them.
+    """
+    bodies = []
+    for song in Song.all(frommetadata=False):
+        try:
+            legacy_transpose(song.body, 1)
+        except ValueError:
+            continue
+        bodies.append(song.body)
+
+    def legacy():
+        for body in bodies:
+            for num in range(12):
+                legacy_transpose(body, num)
+
+    def tokenized():
+        for body in bodies:
+            sheet = ChordSheet(body)
+            for num in range(12):
+                sheet.transpose(num)
+
+    for body in bodies:
+        for num in range(12):
+            assert ChordSheet(body).transpose(num) == \
+                legacy_transpose(body, num)
+
+    click.echo(f"{len(bodies)} songs")
+    click.echo(f"{'legacy':<12}{timeit(legacy, number) / 1000:.1f} ms")
+    click.echo(f"{'tokenized':<12}{timeit(tokenized, number) / 1000:.1f} ms")
+
+
 @cli.command()
 @click.argument('playlist_slug')
 def playlist(playlist_slug):
@@ -300,10 +553,10 @@ def check():
             return False
         return True
 
-    directory: Path = app.config['DIR'] / 'songs'
-    songs = [Song.get(path.name) for path in directory.iterdir()]
-    songs.sort(key=lambda song: unaccented(song.name))
-    num = len(songs)
+    metadata = sorted(cache_utils.scan_songs(), key=itemgetter('sort_key'))
+    filenames = [song['filename'] for song in metadata]
+    num = len(filenames)
+    songs = Song.iterfiles(filenames, ordered=True)
     for i, song in enumerate(songs, start=1):
         print(f"{i}/{num}", end='\t')
         if song.youtube_id:
@@ -343,6 +596,7 @@ def check():
 def related():
     """Analyze sessions and generate related songs."""
     generate_related()
+    cache_utils.fill_related_cache()
 
 
 @cli.command()
@@ -1,5 +1,8 @@
-from flask import url_for
+import json
 
+from flask import current_app, url_for
+
+from buzuki import metrics
 from buzuki.songs import Song
 from tests.factories import SongFactory
 
@@ -107,3 +110,42 @@ def test_save_delete(client):
     resp = client.get(url_for('admin.delete', slug='name'),
                       follow_redirects=True)
     assert 'Δεν υπάρχει τέτοια σελίδα'.encode() in resp.data
+
+
+def test_metrics(client):
+    resp = client.get(url_for('admin.metrics'))
+    assert resp.status_code == 302
+
+    SongFactory(name='name_a').tofile()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    client.get(url_for('main.song', slug='name_a'))
+
+    resp = client.get(url_for('admin.metrics'))
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    data = resp.data.decode()
+    assert 'buzuki_cache_rebuilds_total' \
+        '{cache="catalog",endpoint="main.song"}' in data
+    assert 'buzuki_request_duration_seconds_count{endpoint="main.song",' \
+        'method="GET"}' in data
+    assert 'buzuki_cache_round_trips_per_request_bucket' \
+        '{endpoint="main.song",le="+Inf"}' in data
+
+
+def test_metrics_workers(client):
+    counter = metrics.cache_rebuilds
+    labels = ('catalog', 'main.song')
+    counter.values.pop(counter._labels(labels), None)
+    counter.inc(*labels, amount=2)
+    metrics.flush()
+
+    # The file of another worker
+    directory = current_app.config['METRICS_DIR']
+    (directory / '1.json').write_text(json.dumps({
+        counter.name: [[[['cache', 'catalog'], ['endpoint', 'main.song']], 3]],
+    }))
+
+    data = metrics.render()
+    assert 'buzuki_cache_rebuilds_total' \
+        '{cache="catalog",endpoint="main.song"} 5' in data
@@ -3,6 +3,8 @@ import json
 import pytest
 from flask import url_for
 
+from buzuki import search as search_index
+from buzuki.songs import Song
 from tests.factories import SongFactory
 
 
@@ -75,3 +77,13 @@ def test_api_405(client):
     assert resp.mimetype == 'application/json'
     assert resp.data == \
         b'{"message":"The method is not allowed for the requested URL"}\n'
+
+
+def test_api_search(client, db):
+    search_index.create_index()
+    search_index.index_many(Song.all(frommetadata=False))
+    resp = client.get(url_for('api.search', query='name a'))
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == [
+        {'name': 'name_a', 'slug': 'name_a', 'url': '/songs/name_a/'},
+    ]
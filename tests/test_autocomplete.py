@@ -0,0 +1,61 @@
+import json
+
+from flask import url_for
+
+from buzuki.autocomplete import PrefixTrie, suggest
+from buzuki.songs import Song
+from tests.factories import SongFactory
+
+
+def test_trie():
+    trie = PrefixTrie()
+    trie.add('Καλησπέρα Αργιλέ', '/songs/kalispera_argile/')
+    trie.add('Αργιλέ', '/songs/argile/')
+    trie.add('Καλή', '/songs/kali/')
+
+    def names(query, limit=10):
+        return [item['name'] for item in trie.suggest(query, limit)]
+
+    assert names('καλ') == ['Καλή', 'Καλησπέρα Αργιλέ']
+    assert names('ΚΑΛΗΣ') == ['Καλησπέρα Αργιλέ']
+    assert names('kalisp') == ['Καλησπέρα Αργιλέ']
+    # Names that start with the query come first
+    assert names('αργ') == ['Αργιλέ', 'Καλησπέρα Αργιλέ']
+    assert names('αργ καλ') == ['Καλησπέρα Αργιλέ']
+    assert names('αργ', limit=1) == ['Αργιλέ']
+    assert names('ξ') == []
+    assert names('  ') == []
+
+    trie.remove('/songs/argile/')
+    assert names('αργ') == ['Καλησπέρα Αργιλέ']
+    trie.add('Καληνύχτα', '/songs/kali/')
+    assert names('καλη') == ['Καληνύχτα', 'Καλησπέρα Αργιλέ']
+
+
+def test_suggest(client):
+    SongFactory(name='Καλησπέρα', artist='Μάρκος Βαμβακάρης').tofile()
+    assert suggest('καλ') == [
+        {'name': 'Καλησπέρα', 'url': '/songs/kalispera/'},
+    ]
+    assert suggest('βαμ') == [
+        {'name': 'Μάρκος Βαμβακάρης', 'url': '/artists/markos_vamvakaris/'},
+    ]
+    assert suggest('ουσ') == [{'name': 'Ουσάκ', 'url': '/scales/ousak/'}]
+
+    # Writes are picked up
+    SongFactory(name='Καλημέρα', artist='Μάρκος Βαμβακάρης').tofile()
+    Song.get('kalispera').delete()
+    assert suggest('καλ') == [
+        {'name': 'Καλημέρα', 'url': '/songs/kalimera/'},
+    ]
+
+
+def test_api_autocomplete(client):
+    SongFactory(name='Καλησπέρα').tofile()
+    resp = client.get(url_for('api.autocomplete', q='kali&x=1'))
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == []
+    resp = client.get(url_for('api.autocomplete', q='kali'))
+    assert json.loads(resp.data) == [
+        {'name': 'Καλησπέρα', 'url': '/songs/kalispera/'},
+    ]
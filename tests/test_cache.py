@@ -1,4 +1,14 @@
-from buzuki import cache_utils
+import json
+import os
+import threading
+import time
+
+import pytest
+from flask import current_app
+
+from buzuki import cache, cache_utils, codec, create_app, make_cache
+from buzuki.songs import Song
+from config import TestingConfig
 from tests.factories import SongFactory
 
 
@@ -47,3 +57,400 @@ def test_cache(client):
             }],
         }
     }
+
+
+def test_snapshot(client):
+    SongFactory(name='Ένα').tofile()
+
+    songs = cache_utils.get_songs()
+    assert cache_utils.get_songs() is songs
+
+    # Another worker rebuilt the catalog
+    other = {
+        'dyo': {
+            'name': 'Δύο',
+            'artist': 'artist',
+            'artist_slug': 'artist',
+            'scale': 'scale',
+        },
+    }
+    songs_value, artists_value = codec.encode(other, {})
+    cache.set('songs', songs_value)
+    cache.set('artists', artists_value)
+    cache.set('version', 'other')
+    assert cache_utils.get_songs() == other
+
+    # The catalog was flushed
+    cache.clear()
+    assert list(cache_utils.get_songs()) == ['ena']
+
+
+def test_incremental(client, monkeypatch):
+    SongFactory(artist='Βαμβακάρης', name='Ένα').tofile()
+    SongFactory(artist='Σκαρβέλης', name='Τρία').tofile()
+    cache_utils.get_songs()
+    cache.set('related:ena', {'tria': 1})
+
+    def fill_cache():
+        raise AssertionError("The songs directory shouldn't be scanned")
+
+    monkeypatch.setattr(cache_utils, 'fill_cache', fill_cache)
+
+    SongFactory(artist='Βαμβακάρης', name='Δύο').tofile()
+    assert list(cache_utils.get_songs()) == ['dyo', 'ena', 'tria']
+    assert cache_utils.get_artists()['vamvakaris']['songs'] == [
+        {'name': 'Δύο', 'slug': 'dyo'},
+        {'name': 'Ένα', 'slug': 'ena'},
+    ]
+
+    # Change the artist of a song
+    SongFactory(artist='Αβαγιανός', name='Τρία').tofile()
+    assert cache_utils.get_songs()['tria']['artist_slug'] == 'avagianos'
+    assert list(cache_utils.get_artists()) == ['avagianos', 'vamvakaris']
+
+    Song.get('dyo').delete()
+    assert list(cache_utils.get_songs()) == ['ena', 'tria']
+    assert cache_utils.get_artists()['vamvakaris']['songs'] == [
+        {'name': 'Ένα', 'slug': 'ena'},
+    ]
+
+    assert cache.get('related:ena') == {'tria': 1}
+
+
+def test_incremental_matches_fill(client):
+    SongFactory(artist='Βαμβακάρης', name='Ένα').tofile()
+    cache_utils.get_songs()
+    SongFactory(artist='Τσιτσάνης ', name='Δύο').tofile()
+    SongFactory(artist='Τσιτσάνης', name='Τρία (Ζεϊμπέκικο)').tofile()
+
+    patched = cache_utils.get_catalog()
+    assert 'tsitsanis_' not in patched[1]
+    assert cache_utils.fill_cache() == patched
+
+
+def test_concurrent_patches(client):
+    SongFactory(name='Ένα').tofile()
+    cache_utils.get_songs()
+
+    app = current_app._get_current_object()
+    names = ['Δύο', 'Τρία', 'Τέσσερα', 'Πέντε', 'Έξι', 'Επτά']
+    barrier = threading.Barrier(len(names))
+
+    def worker(name):
+        with app.app_context():
+            song = SongFactory(name=name)
+            barrier.wait()
+            song.tofile()
+
+    threads = [
+        threading.Thread(target=worker, args=(name,)) for name in names
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache_utils.get_songs()) == len(names) + 1
+
+
+def test_patch_lock_busy(client, monkeypatch):
+    SongFactory(name='Ένα').tofile()
+    cache_utils.get_songs()
+
+    # Another worker holds the lock until the wait times out
+    monkeypatch.setattr(cache_utils, '_wait', lambda done: done())
+    assert cache_utils._acquire('catalog')
+    SongFactory(name='Δύο').tofile()
+    assert cache.get('version') is None
+    cache_utils._release('catalog')
+
+    assert list(cache_utils.get_songs()) == ['dyo', 'ena']
+
+
+def test_refill_waits_for_lock(client):
+    SongFactory(name='Ένα').tofile()
+    app = current_app._get_current_object()
+
+    def refill():
+        with app.app_context():
+            cache_utils.refill()
+
+    # A patch is in progress
+    assert cache_utils._acquire('catalog')
+    thread = threading.Thread(target=refill)
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    cache_utils._release('catalog')
+    thread.join(5)
+    assert not thread.is_alive()
+    assert list(cache_utils.get_songs()) == ['ena']
+
+
+def test_single_flight(client, monkeypatch):
+    for name in ['Ένα', 'Δύο', 'Τρία']:
+        SongFactory(name=name).tofile()
+    cache_utils.clear()
+
+    scans = []
+    fill_cache = cache_utils.fill_cache
+
+    def slow_fill_cache():
+        scans.append(True)
+        time.sleep(0.2)
+        return fill_cache()
+
+    monkeypatch.setattr(cache_utils, 'fill_cache', slow_fill_cache)
+
+    app = current_app._get_current_object()
+    num = 8
+    barrier = threading.Barrier(num)
+    results = []
+
+    def worker():
+        with app.app_context():
+            barrier.wait()
+            results.append(list(cache_utils.get_songs()))
+
+    threads = [threading.Thread(target=worker) for _ in range(num)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(scans) == 1
+    assert results == [['dyo', 'ena', 'tria']] * num
+
+
+def test_manifest(client, monkeypatch):
+    SongFactory(name='Ένα').tofile()
+    SongFactory(name='Δύο').tofile()
+    cache_utils.fill_cache()
+    assert (current_app.config['DIR'] / cache_utils.MANIFEST).is_file()
+
+    read = []
+    read_header = cache_utils._read_header
+
+    def counting_read_header(path):
+        read.append(path.name)
+        return read_header(path)
+
+    monkeypatch.setattr(cache_utils, '_read_header', counting_read_header)
+
+    cache_utils.fill_cache()
+    assert read == []
+
+    SongFactory(name='Δύο', artist='Σκαρβέλης').tofile()
+    # Writing the song patches the cache with its header
+    assert read == ['dyo']
+    read.clear()
+    songs, artists = cache_utils.fill_cache()
+    assert read == ['dyo']
+    assert songs['dyo']['artist_slug'] == 'skarvelis'
+    assert list(artists) == ['artist', 'skarvelis']
+
+    Song.get('ena').delete()
+    songs, _ = cache_utils.fill_cache()
+    assert list(songs) == ['dyo']
+
+    # The metadata name the file, which can differ from the slug
+    directory = current_app.config['DIR'] / 'songs'
+    (directory / 'dyo').rename(directory / 'dyo_old')
+    [metadata] = cache_utils.scan_songs()
+    assert metadata['slug'] == 'dyo'
+    assert metadata['filename'] == 'dyo_old'
+    assert Song.fromfile(metadata['filename']).slug == 'dyo'
+
+
+def test_entries(client, monkeypatch):
+    SongFactory(artist='Βαμβακάρης', name='Ένα').tofile()
+    SongFactory(artist='Σκαρβέλης', name='Τρία').tofile()
+    cache_utils.get_songs()
+    SongFactory(artist='Βαμβακάρης', name='Δύο').tofile()
+    Song.get('tria').delete()
+
+    # Make the snapshot stale, as in a worker that didn't do the writes
+    cache_utils._set_snapshot(None, None, None)
+
+    def get_catalog():
+        raise AssertionError("The whole catalog shouldn't be fetched")
+
+    monkeypatch.setattr(cache_utils, '_get_catalog', get_catalog)
+
+    assert cache_utils.get_song('dyo') == {
+        'name': 'Δύο',
+        'artist': 'Βαμβακάρης',
+        'artist_slug': 'vamvakaris',
+        'scale': 'scale',
+    }
+    assert list(cache_utils.get_many_songs(['ena', 'dyo'])) == ['ena', 'dyo']
+    assert cache_utils.get_artist('vamvakaris')['songs'] == [
+        {'name': 'Δύο', 'slug': 'dyo'},
+        {'name': 'Ένα', 'slug': 'ena'},
+    ]
+    assert cache_utils.count_songs() == 2
+
+    monkeypatch.undo()
+    assert cache_utils.get_song('tria') is None
+    assert cache_utils.get_artist('skarvelis') is None
+    assert cache_utils.get_many_songs(['tria', 'ena']) == {
+        'ena': cache_utils.get_song('ena'),
+    }
+
+
+def test_entries_without_old_catalog(client):
+    SongFactory(artist='Βαμβακάρης', name='Ένα').tofile()
+    SongFactory(artist='Σκαρβέλης', name='Τρία').tofile()
+    cache_utils.get_songs()
+
+    # The catalog was evicted, and a worker without a snapshot rebuilds it
+    # after a song was deleted.
+    cache.delete('songs')
+    (current_app.config['DIR'] / 'songs' / 'tria').unlink()
+    cache_utils._set_snapshot(None, None, None)
+    cache_utils.fill_cache()
+
+    cache_utils._set_snapshot(None, None, None)
+    assert cache_utils.get_song('tria') is None
+    assert cache_utils.get_artist('skarvelis') is None
+    assert cache_utils.get_many_songs(['tria', 'ena']) == {
+        'ena': cache_utils.get_song('ena'),
+    }
+
+
+@pytest.mark.parametrize('cache_type', ['simple', 'filesystem'])
+def test_backends(client, tmp_path, cache_type):
+    current_app.config['CACHE_TYPE'] = cache_type
+    current_app.config['CACHE_DIR'] = tmp_path
+    cache.init_app(current_app)
+
+    SongFactory(name='Ένα').tofile()
+    SongFactory(name='Δύο').tofile()
+    assert list(cache_utils.get_songs()) == ['dyo', 'ena']
+
+    SongFactory(name='Τρία').tofile()
+    cache_utils._set_snapshot(None, None, None)
+    assert list(cache_utils.get_songs()) == ['dyo', 'ena', 'tria']
+    assert cache_utils.get_song('tria')['name'] == 'Τρία'
+
+
+def test_filesystem_add(tmp_path):
+    backend = make_cache('filesystem', {'CACHE_DIR': tmp_path})
+    num = 8
+    barrier = threading.Barrier(num)
+    added = []
+
+    def worker(i):
+        barrier.wait()
+        added.append(backend.add('lock', i))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(num)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert added.count(True) == 1
+    assert backend.get('lock') in range(num)
+
+    # Expired values are replaced, by only one of concurrent adds even if
+    # the other one is slow to see that the value has expired.
+    assert backend.add('expired', 1, timeout=1)
+    time.sleep(2)
+    has = backend.has
+
+    def slow_has(key):
+        result = has(key)
+        time.sleep(0.2)
+        return result
+
+    backend.has = slow_has
+    added = {}
+
+    def add(name):
+        added[name] = backend.add('expired', name)
+
+    threads = [threading.Thread(target=add, args=(name,)) for name in 'AB']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(added.values()) == [False, True]
+    assert backend.get('expired') in added
+
+
+def test_warm(client):
+    SongFactory(name='Ένα').tofile()
+    related = current_app.config['DIR'] / 'related.yml'
+    related.write_text('ena:\n  dyo: 5.0\n')
+
+    cache_utils.warm()
+
+    assert cache.get('version') is not None
+    assert cache.get('related:ena') == {'dyo': 5.0}
+    assert len(current_app._hash_cache) > 0
+
+
+def test_create_app_keeps_cache(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(TestingConfig, 'CACHE_TYPE', 'filesystem')
+    monkeypatch.setattr(TestingConfig, 'CACHE_DIR', tmp_path)
+    create_app('testing')
+    cache.set('songs', {})
+    create_app('testing')
+    assert cache.get('songs') == {}
+
+
+def test_fill_related_cache(client):
+    directory = current_app.config['DIR']
+    (directory / 'related.yml').write_text(
+        'ena:\n'
+        '  dyo: 5.0\n'
+        'dyo:\n'
+        '  ena: 5.0\n'
+    )
+    cache_utils.fill_related_cache()
+    assert cache.get('related:ena') == {'dyo': 5.0}
+    assert cache.get('related:dyo') == {'ena': 5.0}
+
+    # The JSON copy is used as long as related.yml is unchanged
+    json_path = directory / cache_utils.RELATED_JSON
+    data = json.loads(json_path.read_text())
+    assert data['related'] == {
+        'ena': {'dyo': 5.0},
+        'dyo': {'ena': 5.0},
+    }
+    data['related'] = {'ena': {'tria': 1.0}}
+    json_path.write_text(json.dumps(data))
+    cache_utils.fill_related_cache()
+    assert cache.get('related:ena') == {'tria': 1.0}
+
+    # related.yml is replaced by a file older than the copy
+    related = directory / 'related.yml'
+    related.write_text('ena:\n  tria: 2.0\n')
+    os.utime(related, ns=(0, 0))
+    cache_utils.fill_related_cache()
+    assert cache.get('related:ena') == {'tria': 2.0}
+
+
+def test_related_file_changed(client):
+    related = current_app.config['DIR'] / 'related.yml'
+    related.write_text('ena:\n  dyo: 5.0\ntria:\n  dyo: 1.0\n')
+    os.utime(related, ns=(1, 1))
+    assert cache_utils.get_related('ena') == {'dyo': 5.0}
+
+    # related.yml was generated again
+    related.write_text('ena:\n  tria: 2.0\n')
+    assert cache_utils.get_related('ena') == {'tria': 2.0}
+    assert cache_utils.get_related('tria') is None
+
+
+def test_stale_format(client):
+    SongFactory(name='Ένα').tofile()
+    cache_utils.get_songs()
+
+    # Catalog written by an older version
+    cache.set('songs', {'dyo': {'name': 'Δύο'}})
+    cache_utils._set_snapshot(None, None, None)
+    assert list(cache_utils.get_songs()) == ['ena']
@@ -0,0 +1,65 @@
+import pytest
+
+from buzuki import codec
+
+songs = {
+    'dyo': {
+        'name': 'Δύο',
+        'artist': 'Βαμβακάρης',
+        'artist_slug': 'vamvakaris',
+        'scale': 'D Ουσάκ',
+    },
+    'ena': {
+        'name': 'Ένα',
+        'artist': 'Βαμβακάρης',
+        'artist_slug': 'vamvakaris',
+        'scale': 'D Ουσάκ',
+    },
+    'tria': {
+        'name': 'Τρία',
+        'artist': 'Σκαρβέλης',
+        'artist_slug': 'skarvelis',
+        'scale': 'E Χιτζάζ',
+    },
+}
+
+artists = {
+    'vamvakaris': {
+        'name': 'Βαμβακάρης',
+        'songs': [
+            {'name': 'Δύο', 'slug': 'dyo'},
+            {'name': 'Ένα', 'slug': 'ena'},
+        ],
+    },
+    'skarvelis': {
+        'name': 'Σκαρβέλης',
+        'songs': [
+            {'name': 'Τρία', 'slug': 'tria'},
+        ],
+    },
+}
+
+
+def test_roundtrip():
+    songs_value, artists_value = codec.encode(songs, artists)
+    decoded = codec.decode(songs_value, artists_value)
+    assert decoded == (songs, artists)
+    assert list(decoded[0]) == list(songs)
+    assert list(decoded[1]) == list(artists)
+
+
+def test_interned():
+    songs_value, _ = codec.encode(songs, artists)
+    strings = songs_value[1]
+    assert strings.count('Βαμβακάρης') == 1
+    assert strings.count('D Ουσάκ') == 1
+
+
+@pytest.mark.parametrize('songs_value, artists_value', [
+    (songs, artists),
+    ((('buzuki-catalog', 0), [], [], [], []), (codec.FORMAT, [], [], [], [])),
+    (None, None),
+])
+def test_invalid_format(songs_value, artists_value):
+    with pytest.raises(codec.InvalidFormat):
+        codec.decode(songs_value, artists_value)
@@ -0,0 +1,115 @@
+import pytest
+
+from buzuki import fulltext
+from buzuki import search as search_index
+from buzuki.artists import Artist
+from buzuki.songs import Song
+from tests.factories import SongFactory
+
+
+@pytest.fixture(scope='function')
+def index(client):
+    SongFactory(
+        name='Καλησπέρα', artist='Βαμβακάρης', body='Στο γλυκό σου πρόσωπο',
+    ).tofile()
+    SongFactory(
+        name='Ο Γιοβάν Τσαούς', artist='Τσιτσάνης', body='Κάτω στα Ζεϊμπέκικα',
+    ).tofile()
+    search_index.create_index()
+    search_index.index_many(
+        Song.all(frommetadata=False) + [Artist.get('vamvakaris')]
+    )
+
+
+def names(query, extra=[]):
+    result = search_index.search(query, extra)
+    return [hit['_source']['name'] for hit in result['hits']['hits']]
+
+
+def test_search(index):
+    # Accents, case and final sigma are ignored
+    assert names('ΚΑΛΗΣΠΕΡΑ') == ['Καλησπέρα']
+    assert names('τσαουσ') == ['Ο Γιοβάν Τσαούς']
+    # Words match as prefixes, in names and bodies, and all must match
+    assert names('καλ') == ['Καλησπέρα']
+    assert names('γλυκ προσ') == ['Καλησπέρα']
+    assert names('γλυκ ζεϊμπ') == []
+    # Greeklish slugs
+    assert names('giovan') == ['Ο Γιοβάν Τσαούς']
+    # Synonyms
+    assert names('Γιάννης') == ['Ο Γιοβάν Τσαούς']
+    assert names('...') == []
+
+
+def test_search_shape(index):
+    hit = search_index.search('καλησπερα')['hits']['hits'][0]
+    assert hit['_id'] == 'songs/kalispera'
+    assert hit['_score'] > 0
+    assert hit['_source'] == {
+        'name': 'Καλησπέρα', 'slug': 'kalispera', 'url': '/songs/kalispera/',
+    }
+
+
+def test_search_extra(index):
+    assert names('βαμβ') == ['Βαμβακάρης']
+    assert names('βαμβ', ['url:artists']) == ['Βαμβακάρης']
+    assert names('βαμβ', ['url:songs']) == []
+    with pytest.raises(ValueError):
+        names('βαμβ', ['name:songs'])
+
+
+def test_update(index):
+    song = Song.get('kalispera')
+    song.name = 'Καληνύχτα'
+    search_index.index(song)
+    search_index.delete('songs/o_giovan_tsaous')
+    assert names('καλην') == ['Καληνύχτα']
+    assert names('τσαους') == []
+
+
+def test_same_slug(index):
+    # A song and an artist with the same slug have separate documents
+    SongFactory(name='Βαμβακάρης', artist='Βαμβακάρης').tofile()
+    search_index.index(Song.get('vamvakaris'))
+    assert names('βαμβ') == ['Βαμβακάρης', 'Βαμβακάρης']
+    search_index.delete('songs/vamvakaris')
+    assert names('βαμβ', ['url:songs']) == []
+    assert names('βαμβ', ['url:artists']) == ['Βαμβακάρης']
+
+
+def test_rebuild_index(index):
+    def items():
+        # The old index is searched until the new one is complete
+        assert names('καλησπερα') == ['Καλησπέρα']
+        yield Song.get('o_giovan_tsaous')
+        assert names('τσαους') == ['Ο Γιοβάν Τσαούς']
+        yield Artist.get('tsitsanis')
+
+    search_index.rebuild_index(items(), chunk_size=1)
+    assert names('καλησπερα') == []
+    assert names('τσ') == ['Τσιτσάνης', 'Ο Γιοβάν Τσαούς']
+
+
+def test_results_cache(index, monkeypatch):
+    calls = []
+    search = fulltext.search
+
+    def counted(query, extra=[]):
+        calls.append(query)
+        return search(query, extra)
+
+    monkeypatch.setattr(fulltext, 'search', counted)
+    assert names('καλησπερα') == ['Καλησπέρα']
+    # Queries are cached by their unaccented and collapsed text
+    assert names(' ΚΑΛΗΣΠΈΡΑ ') == ['Καλησπέρα']
+    assert names('καλησπερα', ['url:songs']) == ['Καλησπέρα']
+    assert calls == ['καλησπερα', 'καλησπερα']
+
+    # Writes to the index invalidate the cache
+    search_index.delete('songs/kalispera')
+    assert names('καλησπερα') == []
+    assert len(calls) == 3
+
+
+def test_no_index(client):
+    assert fulltext.search('καλησπερα')['hits']['hits'] == []
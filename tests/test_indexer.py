@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from buzuki import indexer
+from buzuki import search as search_index
+from buzuki.artists import Artist
+from buzuki.songs import Song
+from tests.factories import SongFactory
+
+
+@pytest.fixture(scope='function')
+def autoindex(client):
+    client.application.config['SEARCH_AUTOINDEX'] = True
+    search_index.create_index()
+    yield
+    indexer.flush()
+
+
+def urls(query):
+    result = search_index.search(query)
+    return sorted(hit['_source']['url'] for hit in result['hits']['hits'])
+
+
+def test_update(autoindex):
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης').tofile()
+    indexer.flush()
+    assert urls('καλησπερα') == ['/songs/kalispera/']
+    assert urls('βαμβακαρης') == ['/artists/vamvakaris/']
+
+    # The old artist has no songs left, so it's deleted
+    song = Song.get('kalispera')
+    song.artist = 'Τσιτσάνης'
+    song.tofile()
+    indexer.flush()
+    assert urls('βαμβακαρης') == []
+    assert urls('τσιτσανης') == ['/artists/tsitsanis/']
+
+    song.delete()
+    indexer.flush()
+    assert urls('καλησπερα') == []
+    assert urls('τσιτσανης') == []
+
+
+def test_update_from_catalog(autoindex, monkeypatch):
+    # The artist is indexed as it's read from the file
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης ').tofile()
+
+    def fromfile(filename):
+        raise AssertionError("The old song shouldn't be parsed")
+
+    monkeypatch.setattr(Song, 'fromfile', fromfile)
+    SongFactory(name='Καλησπέρα', artist='Τσιτσάνης').tofile()
+    indexer.flush()
+    assert urls('βαμβακαρης') == []
+    assert urls('τσιτσανης') == ['/artists/tsitsanis/']
+
+
+def test_background(autoindex):
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης').tofile()
+    deadline = time.monotonic() + 5
+    while not urls('καλησπερα') and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert urls('καλησπερα') == ['/songs/kalispera/']
+
+
+def test_disabled(client):
+    search_index.create_index()
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης').tofile()
+    indexer.flush()
+    assert urls('καλησπερα') == []
+
+
+def test_bulk_import(client, tmp_path):
+    search_index.create_index()
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης').tofile()
+    search_index.index_many([Song.get('kalispera'), Artist.get('vamvakaris')])
+    assert urls('βαμβακαρης') == ['/artists/vamvakaris/']
+
+    for name in ['Καλησπέρα', 'Καληνύχτα']:
+        song = SongFactory(name=name, artist='Τσιτσάνης')
+        song.directory = tmp_path
+        song._write()
+    songs, overwritten = Song.bulk_import(tmp_path)
+    assert len(songs) == 2
+    assert overwritten == ['kalispera']
+
+    # The documents are updated without SEARCH_AUTOINDEX, and the old
+    # artist of the overwritten song is deleted.
+    assert urls('καλη') == ['/songs/kalinyxta/', '/songs/kalispera/']
+    assert urls('βαμβακαρης') == []
+    assert urls('τσιτσανης') == ['/artists/tsitsanis/']
@@ -0,0 +1,54 @@
+import pytest
+
+from buzuki import ngram
+from buzuki.artists import Artist
+from buzuki.mixins import Model
+from buzuki.ngram import NgramIndex
+from buzuki.scales import Scale
+from buzuki.songs import Song
+from tests.factories import SongFactory
+
+
+def test_index():
+    index = NgramIndex([
+        ('Καλησπέρα', 'kalispera'),
+        ('Καλημέρα', 'kalimera'),
+        ('Άλλο', 'allo'),
+    ])
+    assert index.search('καλ') == [0, 1]
+    assert index.search('ΚΑΛΗΣΠΕΡΑ') == [0]
+    assert index.search('λλ') == [2]
+    assert index.search('mera') == [1]
+    assert index.search('ιμερ') == []
+    assert index.search('  ') == [0, 1, 2]
+
+
+@pytest.mark.parametrize('query', [
+    'α', 'ρα', 'Καλη', 'καλησπερα', 'kali', 'Μάρκος Βαμβα', 'markos_v',
+    'ξ', 'xyz', ' ',
+])
+def test_same_as_scan(client, query):
+    SongFactory(name='Καλησπέρα', artist='Μάρκος Βαμβακάρης').tofile()
+    SongFactory(name='Καλημέρα', artist='Μάρκος Βαμβακάρης').tofile()
+    SongFactory(name='Ξένη', artist='Σκαρβέλης').tofile()
+
+    assert list(Song.search(query)) == list(Model.search.__func__(Song, query))
+    assert list(Artist.search(query)) == \
+        list(Model.search.__func__(Artist, query))
+
+
+def test_search(client):
+    SongFactory(name='Καλησπέρα').tofile()
+    songs, artists, scale = ngram.search('Ουσάκ')
+    assert (songs, artists, scale) == ([], [], Scale.get('Ουσάκ'))
+
+    songs, artists, scale = ngram.search('καλη')
+    assert [song.slug for song in songs] == ['kalispera']
+
+    # The index follows changes to the catalog
+    SongFactory(name='Καλημέρα').tofile()
+    songs, artists, scale = ngram.search('καλη')
+    assert [song.slug for song in songs] == ['kalimera', 'kalispera']
+    Song.get('kalispera').delete()
+    songs, artists, scale = ngram.search('καλη')
+    assert [song.slug for song in songs] == ['kalimera']
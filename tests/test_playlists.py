@@ -2,7 +2,7 @@ from textwrap import dedent
 
 import pytest
 
-from buzuki import DoesNotExist, InvalidNote
+from buzuki import DoesNotExist, InvalidNote, playlists
 from buzuki.playlists import Playlist
 from buzuki.songs import Song
 from tests.factories import SongFactory
@@ -167,3 +167,39 @@ def test_remove(client):
           artist_slug: vamvakaris
         """
     )
+
+
+def test_song_playlists(client, monkeypatch):
+    songs = [
+        Song.frommetadata(song_data) for song_data in playlist_data['songs']
+    ]
+    playlist = Playlist(name=playlist_data['name'], songs=songs)
+    playlist.tofile()
+    SongFactory(name='Ασδφ', artist='Ασδφ', scale='D Ουσάκ').tofile()
+
+    neim = SongFactory(name='Νέημ')
+    assert neim.playlists == [
+        {'name': 'Λίστα', 'slug': 'lista', 'member': True, 'root': 'A'},
+    ]
+
+    def fail(*args):
+        raise AssertionError("Unchanged playlists shouldn't be parsed")
+
+    # Changes made with add() and remove() update the index
+    monkeypatch.setattr(playlists.yaml, 'safe_load', fail)
+    playlist.add('asdf', root='C')
+    playlist.remove('neim')
+    assert SongFactory(name='Ασδφ').playlists == [
+        {'name': 'Λίστα', 'slug': 'lista', 'member': True, 'root': 'C'},
+    ]
+    assert neim.playlists == [
+        {'name': 'Λίστα', 'slug': 'lista', 'member': False, 'root': None},
+    ]
+    monkeypatch.undo()
+
+    # Files modified elsewhere are parsed again
+    path = playlist.directory / 'lista.yml'
+    path.write_text('name: Λίστα\nsongs:\n- slug: neim\n')
+    assert neim.playlists[0]['member']
+    path.unlink()
+    assert neim.playlists == []
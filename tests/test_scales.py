@@ -1,7 +1,7 @@
 import pytest
 
 from buzuki import InvalidNote
-from buzuki.scales import Scale
+from buzuki.scales import Scale, link_scales
 
 
 def test_info():
@@ -94,3 +94,11 @@ def test_invalid_root():
     scale.root = 'Fb'
     with pytest.raises(InvalidNote):
         scale.info
+
+
+def test_link_scales(client):
+    assert link_scales('C# Χιτζάζ - Χιτζαζκάρ', 'C#') == (
+        'C# <a href="/scales/xitzaz/Cs">Χιτζάζ</a> - '
+        '<a href="/scales/xitzazkar/Cs">Χιτζαζκάρ</a>'
+    )
+    assert link_scales('D Άγνωστο', 'D') == 'D Άγνωστο'
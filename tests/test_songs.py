@@ -1,7 +1,11 @@
+import shutil
+from pathlib import Path
+
 import pytest
 from flask import current_app as app
 
-from buzuki.songs import Song
+from buzuki import DoesNotExist, InvalidSong, cache_utils, songs
+from buzuki.songs import Song, SongSummary
 from tests.factories import SongFactory
 
 
@@ -16,6 +20,25 @@ def test_eq(client):
     assert SongFactory(name='Καλησπέρα') != 12345
 
 
+def test_summary(client, monkeypatch):
+    SongFactory(name='Καλησπέρα', artist='Βαμβακάρης').tofile()
+
+    def mkdir(*args, **kwargs):
+        raise AssertionError("Listing songs shouldn't touch the disk")
+
+    monkeypatch.setattr(Path, 'mkdir', mkdir)
+    [summary] = Song.all()
+    assert isinstance(summary, SongSummary)
+    assert summary.slug == 'kalispera'
+    assert summary.artist_slug == 'vamvakaris'
+    assert summary.sort_key == 'καλησπερα'
+    assert summary == SongFactory(name='Καλησπέρα')
+    assert SongFactory(name='Καλησπέρα') == summary
+    assert summary != SongFactory(name='καλημερα')
+    with pytest.raises(AttributeError):
+        summary.name = 'Καλημέρα'
+
+
 def test_info(client):
     body = (
         '\n'
@@ -86,3 +109,138 @@ def test_get(client):
     assert song.artist == 'artist'
     assert song.link == 'link'
     assert song.body == 'body'
+
+
+def test_fromfile_cache(client, monkeypatch):
+    SongFactory(body='A  D').tofile()
+    song = Song.fromfile('name')
+    song.body = 'changed'
+
+    def read_text(self):
+        raise AssertionError("The file shouldn't be read again")
+
+    monkeypatch.setattr(Path, 'read_text', read_text)
+    assert Song.fromfile('name').body == 'A  D'
+    monkeypatch.undo()
+
+    # Modified by someone else
+    path = app.config['DIR'] / 'songs' / 'name'
+    path.write_text(path.read_text().replace('A  D', 'A  D  E'))
+    assert Song.fromfile('name').body == 'A  D  E'
+
+    # Modified with tofile(), within the same mtime and size
+    SongFactory(body='B  E  F').tofile()
+    assert Song.fromfile('name').body == 'B  E  F'
+
+    Song.get('name').delete()
+    with pytest.raises(DoesNotExist):
+        Song.fromfile('name')
+
+
+def test_iterfiles(client):
+    names = [f'song{a}{b}' for a in 'abcd' for b in 'abcdefghij']
+    for name in names:
+        SongFactory(name=name, body=f'{name} body').tofile()
+
+    songs = list(Song.iterfiles(names[::-1], ordered=True, workers=4))
+    assert [song.name for song in songs] == names[::-1]
+    assert songs[0].body == 'songdj body'
+
+    songs = Song.iterfiles(fields=['slug', 'body'], workers=4)
+    assert sorted(song['slug'] for song in songs) == sorted(names)
+
+    assert len(Song.all(frommetadata=False)) == 40
+
+
+def test_filenames(client):
+    SongFactory(name='Ένα').tofile()
+    SongFactory(name='Δύο').tofile()
+    # Left by a write that was interrupted
+    directory = app.config['DIR'] / 'songs'
+    (directory / '.tria.tmp').write_text('Τρία')
+
+    assert Song.filenames() == ['dyo', 'ena']
+    loaded = Song.iterfiles(Song.filenames(), ordered=True)
+    assert [song.slug for song in loaded] == ['dyo', 'ena']
+
+
+def test_transposition_cache(client, monkeypatch):
+    SongFactory(scale='D Ουσάκ', body='D  A7  D').tofile()
+    song = Song.get('name', root='E', unicode=True)
+    assert song.body == 'E  B7  E'
+    info = song.info(html=True)
+    assert '/scales/ousak/E' in info
+    assert Song.get('name', semitones=1).body == 'D# A#7 D#'
+
+    def fail(*args):
+        raise AssertionError("The song shouldn't be transposed again")
+
+    monkeypatch.setattr(songs, 'transpose', fail)
+    monkeypatch.setattr(songs.ChordSheet, 'transpose', fail)
+    monkeypatch.setattr(songs, 'link_scales', fail)
+
+    song = Song.get('name', root='E', unicode=True)
+    assert song.root == 'E'
+    assert song.body == 'E  B7  E'
+    assert song.info(html=True) == info
+    assert Song.get('name', semitones=13).body == 'D# A#7 D#'
+    # A root shares the transposition by the same semitones
+    assert Song.get('name', semitones=2, unicode=True).body == 'E  B7  E'
+    monkeypatch.undo()
+
+    # Only the most recent transpositions are kept
+    for semitones in range(12):
+        Song.get('name', semitones=semitones)
+    path = app.config['DIR'] / 'songs' / 'name'
+    stamp, fields, variants = songs._parsed.get(str(path))
+    assert len(variants) == songs.VARIANTS_PER_SONG
+
+    # A modified song doesn't reuse the cached info
+    song.scale = 'E Χιτζάζ'
+    assert '/scales/xitzaz/E' in song.info(html=True)
+
+    SongFactory(scale='D Ουσάκ', body='D  G  D').tofile()
+    assert Song.get('name', root='E', unicode=True).body == 'E  A  E'
+
+
+def test_bulk_import(client, tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ['Πρώτο', 'Δεύτερο']:
+        song = SongFactory(name=name, artist='Βαμβακάρης')
+        song.directory = source
+        song._write()
+    (source / '.hidden').write_text('not a song')
+
+    cache_utils.fill_cache()
+    fills = []
+    fill_cache = cache_utils.fill_cache
+    monkeypatch.setattr(
+        cache_utils, 'fill_cache', lambda: fills.append(fill_cache())
+    )
+    songs, overwritten = Song.bulk_import(source, index=False)
+    assert sorted(song.slug for song in songs) == ['deutero', 'proto']
+    assert overwritten == []
+    assert len(fills) == 1
+    assert cache_utils.count_songs() == 2
+    assert Song.get('proto').artist == 'Βαμβακάρης'
+
+    archive = shutil.make_archive(tmp_path / 'songs', 'zip', source)
+    songs, overwritten = Song.bulk_import(Path(archive), index=False)
+    assert len(songs) == 2
+    assert overwritten == ['deutero', 'proto']
+    archive = shutil.make_archive(tmp_path / 'songs', 'gztar', source)
+    songs, _ = Song.bulk_import(Path(archive), index=False)
+    assert len(songs) == 2
+
+
+def test_bulk_import_invalid(client, tmp_path):
+    song = SongFactory(name='Πρώτο')
+    song.directory = tmp_path
+    song._write()
+    (tmp_path / 'invalid').write_text('name\nartist\n')
+
+    with pytest.raises(InvalidSong, match='invalid: Not a song file'):
+        Song.bulk_import(tmp_path)
+    with pytest.raises(DoesNotExist):
+        Song.get('proto')
@@ -1,9 +1,12 @@
+import threading
+from collections import OrderedDict
 from textwrap import dedent
 
 import pytest
 
 from buzuki import InvalidNote
-from buzuki.utils import distance, greeklish, transpose, unaccented
+from buzuki.utils import (ChordSheet, LRUCache, distance, greeklish, transpose,
+                          unaccented)
 
 
 def test_distance():
@@ -72,11 +75,25 @@ class TestTraspose:
         transposed = transpose(original, 1)
         assert transposed == one_up
 
-    def test_untransposable(self):
-        # Currently doesn't work for a song with both sharps and flats
-        original = "A# Bb"
-        with pytest.raises(ValueError):
-            transpose(original, 1)
+    @pytest.mark.parametrize('original, semitones, expected', [
+        ('A# Bb', 1, 'B  B'),
+        ('C#m   Eb7', 2, 'Ebm   F7'),
+        ('E#  B#  Fb  Cb', 0, 'F   C   E   B'),
+    ])
+    def test_mixed_accidentals(self, original, semitones, expected):
+        assert transpose(original, semitones) == expected
+
+    def test_chord_sheet(self):
+        sheet = ChordSheet('Dm    A7\nΠερνούσα   | 2x\n\nGm/Bb')
+        assert sheet.flats
+        assert sheet.lines == [
+            [(0, 1, 'm', 4), (7, 1, '7', 0)],
+            ['Περνούσα   | 2x'],
+            [],
+            [(5, 1, 'm/', 0), (8, 2, '', 0)],
+        ]
+        assert sheet.transpose(0) == 'Dm    A7\nΠερνούσα   | 2x\n\nGm/Bb'
+        assert sheet.transpose(1) == 'Ebm   Bb7\nΠερνούσα   | 2x\n\nAbm/B'
 
 
 @pytest.mark.parametrize('string, expected', [
@@ -84,6 +101,9 @@ class TestTraspose:
     ('τεστ τεστ', 'test_test'),
     ('Τουτ\' οι μπάτσοι', 'tout_oi_mpatsoi'),
     ('Γιατί φουμάρω κοκαΐνη', 'giati_foumaro_kokaini'),
+    ('ΑΥΤΟΣ Ο ΔΡΟΜΟΣ', 'autos_o_dromos'),
+    ('Ψαράς ξενιτεύτηκε, Θεός!', 'psaras_kseniteutike_theos'),
+    ('Ρεμπέτικο 1935', 'rempetiko_'),
 ])
 def test_greeklish(string, expected):
     assert greeklish(string) == expected
@@ -94,6 +114,26 @@ def test_greeklish(string, expected):
     ('τεστ τεστ', 'τεστ τεστ'),
     ('Τουτ\' οι μπάτσοι', 'τουτ\' οι μπατσοι'),
     ('Γιατί φουμάρω κοκαΐνη', 'γιατι φουμαρω κοκαινη'),
+    ('ΑΥΤΟΣ Ο ΔΡΟΜΟΣ', 'αυτος ο δρομος'),
+    ('Ψαράς ξενιτεύτηκε, Θεός!', 'ψαρας ξενιτευτηκε, θεος!'),
+    ('Plain ASCII', 'plain ascii'),
 ])
 def test_unaccented(string, expected):
     assert unaccented(string) == expected
+
+
+def test_lru_cache_threads():
+    cache = LRUCache(8)
+    cache.set('key', 1)
+
+    class Data(OrderedDict):
+        def __getitem__(self, key):
+            value = super().__getitem__(key)
+            # Another thread pops the key in the middle of `get`
+            thread = threading.Thread(target=cache.pop, args=(key,))
+            thread.start()
+            thread.join(0.1)
+            return value
+
+    cache._data = Data(cache._data)
+    assert cache.get('key') == 1